@@ -1,17 +1,35 @@
-from skimage import io, measure, metrics, util, img_as_ubyte
 from os.path import splitext, split
-from decimal import *
-from skimage.draw import rectangle
 import json
-import time
-import re
-import cv2
 import os
-import tempfile
-from skimage.util import img_as_ubyte
-from imutils.object_detection import non_max_suppression
 import sys
-EAST_CONFIDENCE=0.5
+import hashlib
+import threading
+from collections import OrderedDict
+from .lazy import lazy_import
+from . import pages
+from . import sources
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# Parsed mask definitions by content hash and compiled comparison masks by (content hash, page, shape, DPI)
+MASK_CACHE_SIZE = 64
+_placeholder_definitions = OrderedDict()
+_comparison_masks = OrderedDict()
+_mask_cache_lock = threading.Lock()
+
+
+def _cached(cache, key, create):
+    with _mask_cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = create()
+    with _mask_cache_lock:
+        cache[key] = value
+        while len(cache) > MASK_CACHE_SIZE:
+            cache.popitem(last=False)
+    return value
 
 class CompareImage(object):
 
@@ -19,98 +37,128 @@ class CompareImage(object):
     DPI=200
     
     def __init__(self, image, **kwargs):
-        tic = time.perf_counter()
-
         self.placeholder_file = kwargs.pop('placeholder_file', None)
         self.mask = kwargs.pop('mask', None)
-        self.image = str(image)
-        self.path, self.filename= split(image)
+        # With load=False no pages are decoded, placeholders are resolved per page with page_placeholders
+        load = kwargs.pop('load', True)
+        # Already decoded pages, e.g. from the reference store
+        images = kwargs.pop('images', None)
+        # cv2.IMREAD_* flags, see sources.decode_flags. Placeholders are defined in full resolution pixels
+        self.flags = kwargs.pop('flags', None)
+        self.scale = sources.decode_mode(self.flags)[1] if self.flags is not None else 1
+        # numpy arrays, bytes and base64 strings are decoded in memory, self.image describes them
+        self.source = image
+        self.image = sources.describe(image)
+        self.path, self.filename= split(self.image)
         self.filename_without_extension, self.extension = splitext(self.filename)
         self.opencv_images = []
         self.placeholders = []
-        self.placeholder_mask = None
+        self.placeholder_definitions = []
+        self.mask_hash = None
         self.placeholder_frame_width = 10
-        self.tmp_directory = tempfile.TemporaryDirectory()
         self.diff_images = []
         self.threshold_images = []
-        self.load_image_into_array()
+        if images is not None:
+            self.DPI = 72
+            self.opencv_images = list(images)
+        elif load:
+            self.load_image_into_array()
+        else:
+            # images are always compared at 72 DPI, see load_image_into_array
+            self.DPI = 72
         self.load_text_content_and_identify_masks()
-        
-    
-        toc = time.perf_counter()
-        print(f"Compare Image Object created in {toc - tic:0.4f} seconds")
 
         
     def identify_placeholders(self):
+        placeholders = None
         if self.placeholder_file is not None:
             try:
-                with open(self.placeholder_file, 'r') as f:
-                    placeholders = json.load(f)
+                with open(self.placeholder_file, 'rb') as f:
+                    content = f.read()
+                self.mask_hash = hashlib.sha1(content).hexdigest()
+                placeholders = _cached(_placeholder_definitions, self.mask_hash, lambda: json.loads(content))
             except IOError as err:
-                print("Placeholder File %s is not accessible", self.placeholder_file)
-                print("I/O error: {0}".format(err))
+                raise AssertionError('The placeholder file {} is not accessible: {}'.format(self.placeholder_file, err))
             except:
                 print("Unexpected error:", sys.exc_info()[0])
                 raise
         elif self.mask is not None:
             try:
-                placeholders = json.loads(self.mask)
+                self.mask_hash = hashlib.sha1(self.mask.encode()).hexdigest()
+                placeholders = _cached(_placeholder_definitions, self.mask_hash, lambda: json.loads(self.mask))
             except:
                 print('The mask {} could not be read as JSON'.format(self.mask))
+        if placeholders is None:
+            return
         if isinstance(placeholders, list) is not True:
             placeholders = [placeholders]
-        if (placeholders is not None):
-            for placeholder in placeholders:
-                placeholder_type = str(placeholder.get('type'))
-                if (placeholder_type == 'coordinates'):
-                    # print("Coordinate placeholder identified:")
-                    # print(placeholder)
-                    page = placeholder.get('page', 'all')
-                    unit = placeholder.get('unit', 'px')
-                    if unit == 'px':
-                        x, y, h, w = (placeholder['x'], placeholder['y'], placeholder['height'], placeholder['width'])                    
-                    elif unit == 'mm':
-                        constant = self.DPI / 25.4
-                        x, y, h, w = (int(placeholder['x']*constant), int(placeholder['y']*constant), int(placeholder['height']*constant), int(placeholder['width']*constant))
-                    elif unit == 'cm':
-                        constant = self.DPI / 2.54
-                        x, y, h, w = (int(placeholder['x']*constant), int(placeholder['y']*constant), int(placeholder['height']*constant), int(placeholder['width']*constant))
-                    placeholder_coordinates = {"page":page, "x":x, "y":y, "height":h, "width":w}
-                    self.placeholders.append(placeholder_coordinates)
-
-                elif (placeholder_type == 'area'):
-                    page = placeholder.get('page', 'all')
-                    location = placeholder.get('location', None)
-                    percent = placeholder.get('percent', 10)
-                    if page == 'all':
-                        image_height = self.opencv_images[0].shape[0]
-                        image_width = self.opencv_images[0].shape[1]
-                    else:
-                        image_height = self.opencv_images[page-1].shape[0]
-                        image_width = self.opencv_images[page-1].shape[1]
-                    if location == 'top':
-                        height = int(image_height * percent / 100)
-                        width = image_width
-                        placeholder_coordinates = {"page":page, "x":0, "y":0, "height":height, "width":width}
-                        pass
-                    elif location == 'bottom':
-                        height = int(image_height * percent / 100)
-                        width = image_width
-                        placeholder_coordinates = {"page":page, "x":0, "y":image_height - height, "height":height, "width":width}
-                    elif location == 'left':
-                        height = image_height
-                        width = int(image_width * percent / 100)
-                        placeholder_coordinates = {"page":page, "x":0, "y":0, "height":height, "width":width}
-                    elif location == 'right':
-                        height = image_height
-                        width = int(image_width * percent / 100)
-                        placeholder_coordinates = {"page":page, "x":image_width - width, "y":0, "height":height, "width":width}
-                    self.placeholders.append(placeholder_coordinates)
+        self.placeholder_definitions = placeholders
+        if not self.opencv_images:
+            return
+        for placeholder in placeholders:
+            placeholder_coordinates = self.resolve_placeholder(placeholder, lambda page: self.opencv_images[0 if page == 'all' else int(page)-1].shape)
+            if placeholder_coordinates is not None:
+                self.placeholders.append(placeholder_coordinates)
+
+    def page_placeholders(self, page_number, page_shape):
+        """Returns the resolved placeholders of page ``page_number`` (starting at 1) of a not loaded document.
+
+        ``page_shape(page)`` returns the shape of the page an area placeholder refers to: the first page for ``all``.
+        """
+        placeholders = []
+        for placeholder in self.placeholder_definitions:
+            page = placeholder.get('page', 'all')
+            if page == 'all' or int(page) == page_number:
+                placeholder_coordinates = self.resolve_placeholder(placeholder, page_shape)
+                if placeholder_coordinates is not None:
+                    placeholders.append(placeholder_coordinates)
+        return placeholders
+
+    def resolve_placeholder(self, placeholder, page_shape):
+        """Returns the pixel coordinates of a placeholder definition, or None for unknown placeholder types."""
+        placeholder_coordinates = None
+        placeholder_type = str(placeholder.get('type'))
+        if (placeholder_type == 'coordinates'):
+            page = placeholder.get('page', 'all')
+            unit = placeholder.get('unit', 'px')
+            if unit == 'px':
+                x, y, h, w = (placeholder['x'], placeholder['y'], placeholder['height'], placeholder['width'])                    
+            elif unit == 'mm':
+                constant = self.DPI / 25.4
+                x, y, h, w = (int(placeholder['x']*constant), int(placeholder['y']*constant), int(placeholder['height']*constant), int(placeholder['width']*constant))
+            elif unit == 'cm':
+                constant = self.DPI / 2.54
+                x, y, h, w = (int(placeholder['x']*constant), int(placeholder['y']*constant), int(placeholder['height']*constant), int(placeholder['width']*constant))
+            placeholder_coordinates = {"page":page, "x":x, "y":y, "height":h, "width":w}
+
+        elif (placeholder_type == 'area'):
+            page = placeholder.get('page', 'all')
+            location = placeholder.get('location', None)
+            percent = placeholder.get('percent', 10)
+            image_height, image_width = (dimension * self.scale for dimension in page_shape(page)[:2])
+            if location == 'top':
+                height = int(image_height * percent / 100)
+                width = image_width
+                placeholder_coordinates = {"page":page, "x":0, "y":0, "height":height, "width":width}
+                pass
+            elif location == 'bottom':
+                height = int(image_height * percent / 100)
+                width = image_width
+                placeholder_coordinates = {"page":page, "x":0, "y":image_height - height, "height":height, "width":width}
+            elif location == 'left':
+                height = image_height
+                width = int(image_width * percent / 100)
+                placeholder_coordinates = {"page":page, "x":0, "y":0, "height":height, "width":width}
+            elif location == 'right':
+                height = image_height
+                width = int(image_width * percent / 100)
+                placeholder_coordinates = {"page":page, "x":image_width - width, "y":0, "height":height, "width":width}
+        return placeholder_coordinates
     
-    def get_image_with_placeholders(self, placeholders=None):
+    def get_image_with_placeholders(self, placeholders=None, images=None):
         if placeholders is None:
             placeholders = self.placeholders
-        images_with_placeholders = self.opencv_images
+        images_with_placeholders = self.opencv_images if images is None else images
         for placeholder in placeholders:
             if placeholder['page'] == 'all':
                 for i in range(len(images_with_placeholders)):
@@ -132,11 +180,54 @@ class CompareImage(object):
                     print("Placeholder ", placeholder, " could not be applied")
         return images_with_placeholders
 
+    def get_comparison_mask(self, page, shape=None, placeholders=None):
+        """Returns the placeholders of ``page`` compiled into a mask, or None if the page has no placeholders.
+
+        ``placeholders`` are the resolved placeholders of the page, see `page_placeholders`. By default they are
+        taken from the placeholders of the loaded document.
+
+        The mask is an uint8 array as used by OpenCV: 255 for pixels which are compared, 0 for pixels
+        covered by a placeholder (including the same 5 pixel margin that `get_image_with_placeholders` paints).
+        Masks are cached per mask content, page, image shape and DPI and must not be modified.
+        """
+        if shape is None:
+            shape = self.opencv_images[page].shape
+        if placeholders is None:
+            placeholders = [placeholder for placeholder in self.placeholders if placeholder['page'] == 'all' or int(placeholder['page']) - 1 == page]
+            mask_hash = self.mask_hash or hashlib.sha1(repr(self.placeholders).encode()).hexdigest()
+        else:
+            # areas of resolved placeholders depend on the page sizes, not only on the mask content
+            mask_hash = hashlib.sha1(repr(placeholders).encode()).hexdigest()
+        if placeholders == []:
+            return None
+        key = (mask_hash, page, tuple(shape[:2]), self.DPI, self.scale)
+        return _cached(_comparison_masks, key, lambda: self._compile_comparison_mask(placeholders, shape))
+
+    def _compile_comparison_mask(self, placeholders, shape):
+        mask = np.full(shape[:2], 255, dtype=np.uint8)
+        for placeholder in placeholders:
+            start_point = (int(placeholder['x']-5), int(placeholder['y']-5))
+            end_point = (int(start_point[0]+placeholder['width']+10), int(start_point[1]+placeholder['height']+10))
+            if self.scale > 1:
+                # pages decoded at a reduced scale, partially covered pixels are excluded as well
+                start_point = tuple(coordinate // self.scale for coordinate in start_point)
+                end_point = tuple(-(-coordinate // self.scale) for coordinate in end_point)
+            cv2.rectangle(mask, start_point, end_point, 0, -1)
+        mask.setflags(write=False)
+        return mask
+
     def load_image_into_array(self):
-        if (os.path.isfile(self.image) is False):
+        if sources.is_image_data(self.source):
+            self.DPI = 72
+            self.opencv_images = [sources.decode(self.source, self.flags)]
+            return
+        if (os.path.exists(self.image) is False):
             raise AssertionError('The file does not exist: {}'.format(self.image))
         self.DPI = 72
-        img = cv2.imread(self.image)
+        if pages.is_multi_page(self.image):
+            self.opencv_images = list(pages.iter_pages(self.image, self.flags))
+            return
+        img = cv2.imread(self.image, cv2.IMREAD_COLOR if self.flags is None else self.flags)
         if img is None:
             raise AssertionError("No OpenCV Image could be created for file {} . Maybe the file is corrupt?".format(self.image))
         if self.opencv_images:
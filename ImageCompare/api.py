@@ -0,0 +1,56 @@
+"""Python API for comparing images outside of Robot Framework.
+
+``ImageComparator`` wraps an ``ImageCompare`` library instance whose Robot
+Framework variables are fixed on creation, so comparisons never call
+``BuiltIn()``::
+
+    from ImageCompare.api import ImageComparator
+
+    with ImageComparator(output_directory='results', engine='opencv') as comparator:
+        result = comparator.compare('reference.png', screenshot_png_bytes)
+        if not result['passed']:
+            print(result['message'])
+
+Images may be file paths, numpy arrays, encoded ``bytes`` or base64 strings,
+see ``Compare Images``. Screenshots are written to ``output_directory/screenshots``.
+"""
+
+import os
+
+from .imagecompare import ImageCompare
+
+
+class ImageComparator(object):
+
+    def __init__(self, output_directory=None, reference_run=False, **library_arguments):
+        """``library_arguments`` are the arguments of the library import, e.g. ``take_screenshots=True``."""
+        self.output_directory = os.path.abspath(output_directory or os.getcwd())
+        self.library = ImageCompare(**library_arguments)
+        self.library.robot_variables = {'${REFERENCE_RUN}': reference_run, '${LOG FILE}': 'NONE',
+                                        '${OUTPUTDIR}': self.output_directory}
+
+    def compare(self, reference_image, test_image, **kwargs):
+        """Compares the images like ``Compare Images`` and returns its metrics with ``passed`` and ``message``.
+
+        Failed comparisons, e.g. different images or missing files, do not raise an exception.
+        Invalid arguments raise ``ValueError``.
+        """
+        passed, message = True, ''
+        try:
+            self.library.compare_images(reference_image, test_image, **kwargs)
+        except AssertionError as error:
+            passed, message = False, str(error)
+        return dict(self.library.last_metrics.as_dict(), passed=passed, message=message)
+
+    def flush(self):
+        """Waits until all screenshots are written."""
+        self.library.flush_artifacts()
+
+    def close(self):
+        self.library.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
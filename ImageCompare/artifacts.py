@@ -0,0 +1,111 @@
+"""Background writer for screenshots added to the log.
+
+Encoding large images as JPEG/PNG often takes longer than the comparison itself.
+The ``ArtifactWriter`` encodes and writes images in worker threads, so that the
+comparison can continue as soon as an image is queued. The queue is bounded:
+``submit`` blocks while it is full, which limits the memory held by pending images.
+
+Images may be submitted as lists of panels of the same height. They are resized
+and concatenated by the worker thread, so the comparison never builds the
+full resolution concatenation.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+
+class ArtifactWriter(object):
+
+    def __init__(self, workers=2, queue_size=8):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def submit(self, path, image, params=None, callback=None, max_dimension=0):
+        """Queues ``image`` (or a list of panels) to be written to ``path``. Blocks while the queue is full.
+
+        The caller must not modify ``image`` afterwards. ``callback(seconds, bytes_written)`` is called
+        by the worker thread after the file is written.
+        """
+        self._start()
+        self._queue.put((path, image, params or [], callback, max_dimension))
+
+    def flush(self):
+        """Waits until all queued images are written and returns the errors which occurred meanwhile."""
+        self._queue.join()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def close(self):
+        """Writes all queued images and stops the worker threads. Returns the errors which occurred."""
+        errors = self.flush()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='ImageCompareArtifactWriter', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, image, params, callback, max_dimension = item
+                tic = time.perf_counter()
+                bytes_written = write_image(path, image, params, max_dimension=max_dimension)
+                if callback is not None:
+                    callback(time.perf_counter() - tic, bytes_written)
+            except Exception as error:
+                with self._lock:
+                    self._errors.append('Screenshot {} could not be written: {}'.format(item[0], error))
+            finally:
+                self._queue.task_done()
+
+
+def compose(image, max_dimension=0):
+    """Returns ``image`` or its list of panels side by side, downscaled so that neither side exceeds ``max_dimension``.
+
+    Panels are resized before they are concatenated, so the full resolution concatenation is never built.
+    """
+    panels = list(image) if isinstance(image, (list, tuple)) else [image]
+    if max_dimension:
+        scale = max_dimension / max(sum(panel.shape[1] for panel in panels), max(panel.shape[0] for panel in panels))
+        if scale < 1:
+            panels = [cv2.resize(panel, (max(int(panel.shape[1] * scale), 1), max(int(panel.shape[0] * scale), 1)),
+                                 interpolation=cv2.INTER_AREA) for panel in panels]
+    if len(panels) == 1:
+        return panels[0]
+    if any(panel.ndim == 3 for panel in panels):
+        # grayscale difference maps next to color pages
+        panels = [cv2.cvtColor(panel, cv2.COLOR_GRAY2BGR) if panel.ndim == 2 else panel for panel in panels]
+    return np.concatenate(panels, axis=1)
+
+
+def write_image(path, image, params=None, max_dimension=0):
+    image = compose(image, max_dimension)
+    target_dir = os.path.dirname(path)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+    if not cv2.imwrite(path, image, params or []):
+        raise IOError('cv2.imwrite failed')
+    return os.path.getsize(path)
@@ -0,0 +1,159 @@
+"""Batch comparison of many image pairs in a pool of worker processes.
+
+Each worker process creates its own ``ImageCompare`` library instance with the
+import arguments of the calling library and runs ``compare_images`` for one
+pair at a time. The output of each comparison (including screenshot links) is
+captured in the worker and written to the log by the calling process as soon as
+the pair is finished.
+"""
+
+import csv
+import html
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent import futures
+from contextlib import redirect_stdout
+
+from robot.api import logger
+from robot.output.stdoutlogsplitter import StdoutLogSplitter
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def collect_pairs_from_directories(reference_directory, candidate_directory):
+    """Returns ``(reference, candidate)`` pairs for all images with the same relative path in both directories.
+
+    Images which exist only in one of the directories are paired with a not existing file,
+    so that they are reported as failed comparisons.
+    """
+    relative_paths = set()
+    for directory in (reference_directory, candidate_directory):
+        if not os.path.isdir(directory):
+            raise AssertionError('The directory does not exist: {}'.format(directory))
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    relative_paths.add(os.path.relpath(os.path.join(root, filename), directory))
+    return [(os.path.join(reference_directory, path), os.path.join(candidate_directory, path)) for path in sorted(relative_paths)]
+
+
+def read_manifest(manifest):
+    """Returns the ``(reference, candidate)`` pairs of a manifest.
+
+    ``manifest`` is either a list of pairs or the path of a JSON file (list of pairs or of
+    objects with ``reference`` and ``candidate`` keys) or of a CSV file with two columns.
+    Relative paths in manifest files are relative to the manifest file.
+    """
+    if not isinstance(manifest, str):
+        return [_pair(entry) for entry in manifest]
+    if not os.path.isfile(manifest):
+        raise AssertionError('The manifest file does not exist: {}'.format(manifest))
+    base_directory = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline='') as f:
+        if manifest.lower().endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+    return [tuple(os.path.join(base_directory, path) for path in _pair(entry)) for entry in entries]
+
+
+def _pair(entry):
+    if isinstance(entry, dict):
+        return entry['reference'], entry['candidate']
+    reference, candidate = entry
+    return reference, candidate
+
+
+_worker_libraries = {}
+
+
+def _worker_library(library_arguments):
+    """Returns the library instance of this worker process, so that its executor and caches are reused."""
+    key = repr(sorted(library_arguments.items()))
+    if key not in _worker_libraries:
+        from .imagecompare import ImageCompare
+        # Parallelism comes from the worker processes, a single thread per process avoids oversubscription.
+        # The metrics are returned with each result and reported by the parent process.
+        _worker_libraries[key] = ImageCompare(**dict(library_arguments, max_workers=1, metrics_report=None))
+    return _worker_libraries[key]
+
+
+def compare_pair(library_arguments, robot_variables, reference_image, test_image, options):
+    """Compares one pair in a worker process and returns the result as a dictionary."""
+    library = _worker_library(library_arguments)
+    library.robot_variables = robot_variables
+    library.last_metrics = None
+    output = io.StringIO()
+    tic = time.perf_counter()
+    passed, message = True, ''
+    try:
+        with redirect_stdout(output):
+            try:
+                library.compare_images(reference_image, test_image, **options)
+            finally:
+                # Screenshots must be complete before the calling process logs them
+                library.flush_artifacts()
+    except Exception as error:
+        passed, message = False, str(error)
+    toc = time.perf_counter()
+    metrics = library.last_metrics.as_dict() if library.last_metrics is not None else None
+    return {'reference': reference_image, 'candidate': test_image, 'passed': passed,
+            'message': message, 'output': output.getvalue(), 'duration': toc - tic, 'metrics': metrics}
+
+
+def _mp_context():
+    """Start method of the worker processes.
+
+    The calling process already runs executor and screenshot writer threads, and forking
+    a multi-threaded process can deadlock the children. The workers import OpenCV anyway.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def run_batch(library_arguments, robot_variables, pairs, options, workers):
+    """Runs all comparisons of ``pairs`` in ``workers`` processes.
+
+    Results are logged as they arrive. Returns the results in the order of ``pairs``.
+    """
+    results = [None] * len(pairs)
+    with futures.ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as executor:
+        pending = {executor.submit(compare_pair, library_arguments, robot_variables, reference, candidate, options): index
+                   for index, (reference, candidate) in enumerate(pairs)}
+        for future in futures.as_completed(pending):
+            index = pending[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                reference, candidate = pairs[index]
+                result = {'reference': reference, 'candidate': candidate, 'passed': False,
+                          'message': 'Worker process failed: {}'.format(error), 'output': '', 'duration': 0.0, 'metrics': None}
+            results[index] = result
+            _log_result(index, len(pairs), result)
+    return results
+
+
+def _log_result(index, total, result):
+    status = 'PASS' if result['passed'] else 'FAIL'
+    logger.info('[{}/{}] {}: {} vs. {} ({:0.4f} seconds) {}'.format(
+        index + 1, total, status, result['reference'], result['candidate'], result['duration'], result['message']).rstrip())
+    for message in StdoutLogSplitter(result['output']):
+        logger.write(message.message, message.level, message.html)
+
+
+def log_summary(results):
+    rows = []
+    for index, result in enumerate(results):
+        status = 'PASS' if result['passed'] else 'FAIL'
+        color = '#97bd61' if result['passed'] else '#ce3e01'
+        rows.append('<tr><td>{}</td><td>{}</td><td>{}</td><td style="color:{}">{}</td><td>{:0.4f}</td><td>{}</td></tr>'.format(
+            index + 1, html.escape(result['reference']), html.escape(result['candidate']), color, status,
+            result['duration'], html.escape(result['message'])))
+    failed = sum(1 for result in results if not result['passed'])
+    logger.info('<table border="1"><tr><th>#</th><th>Reference</th><th>Candidate</th><th>Result</th><th>Seconds</th><th>Message</th></tr>'
+                '{}</table><p>{} compared, {} passed, {} failed</p>'.format(''.join(rows), len(results), len(results) - failed, failed), html=True)
+    return failed
@@ -0,0 +1,164 @@
+"""Process-wide LRU cache for decoded reference images.
+
+Reference images are usually compared many times per run. The cache keeps the
+decoded pages, their comparison masks, the grayscale images and the reference
+side Gaussian moments used by the ``opencv`` SSIM engine, so that repeated
+comparisons against the same reference skip decoding and preprocessing.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from .lazy import lazy_import
+from .ssim import gaussian_moments
+
+cv2 = lazy_import('cv2')
+
+
+def _read_only(image):
+    image.setflags(write=False)
+    return image
+
+
+class ReferenceCacheEntry(object):
+    """Decoded reference document and the data derived from it.
+
+    All arrays are read-only, as they are shared by all comparisons against the reference.
+    Grayscale images and moments are computed on first use.
+    """
+
+    def __init__(self, compare_image, gray_images=None):
+        self.placeholders = compare_image.placeholders
+        self.opencv_images = [_read_only(image) for image in compare_image.opencv_images]
+        # Compiled placeholders per page, None for pages without placeholders
+        self.masks = [compare_image.get_comparison_mask(page) for page in range(len(self.opencv_images))]
+        self.gray_images = list(gray_images) if gray_images is not None else [None] * len(self.opencv_images)
+        self.moments = [None] * len(self.opencv_images)
+        self.cache = None
+
+    @property
+    def nbytes(self):
+        arrays = list(self.opencv_images)
+        arrays += [mask for mask in self.masks if mask is not None]
+        arrays += [gray for gray in self.gray_images if gray is not None]
+        arrays += [array for moments in self.moments if moments is not None for array in moments]
+        return sum(array.nbytes for array in arrays)
+
+    def gray(self, page):
+        if self.opencv_images[page].ndim == 2:
+            # decoded in grayscale
+            return self.opencv_images[page]
+        if self.gray_images[page] is None:
+            self.gray_images[page] = _read_only(cv2.cvtColor(self.opencv_images[page], cv2.COLOR_BGR2GRAY))
+            self._grown()
+        return self.gray_images[page]
+
+    def gaussian_moments(self, page):
+        if self.moments[page] is None:
+            self.moments[page] = tuple(_read_only(array) for array in gaussian_moments(self.gray(page)))
+            self._grown()
+        return self.moments[page]
+
+    def _grown(self):
+        if self.cache is not None:
+            self.cache.update_size(self)
+
+
+class ReferenceCache(object):
+    """Thread-safe LRU cache of ``ReferenceCacheEntry`` objects with a memory budget in bytes."""
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(image, placeholder_file=None, mask=None, DPI=None, flags=None):
+        """Cache key of a reference file: path, mtime, size, mask and decode flags."""
+        stat = os.stat(image)
+        placeholder_key = None
+        if placeholder_file is not None:
+            placeholder_stat = os.stat(placeholder_file)
+            placeholder_key = (os.path.abspath(placeholder_file), placeholder_stat.st_mtime_ns, placeholder_stat.st_size)
+        return (os.path.abspath(image), stat.st_mtime_ns, stat.st_size, placeholder_key, mask, DPI, flags)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def size(self):
+        return sum(self._sizes.values())
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            if not self.enabled or entry.nbytes > self.max_bytes:
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._sizes[key] = entry.nbytes
+            entry.cache = self
+            self._evict(keep=key)
+            return entry
+
+    def update_size(self, entry):
+        with self._lock:
+            for key, cached_entry in self._entries.items():
+                if cached_entry is entry:
+                    self._sizes[key] = entry.nbytes
+                    self._evict(keep=key)
+                    return
+
+    def invalidate(self, image):
+        """Removes all entries of the reference file ``image``."""
+        path = os.path.abspath(image)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def statistics(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'size': self.size, 'max_size': self.max_bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        entry.cache = None
+        del self._sizes[key]
+
+    def _evict(self, keep=None):
+        for key in list(self._entries):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            self.evictions += 1
+        if self.size > self.max_bytes and keep in self._entries:
+            self._remove(keep)
+            self.evictions += 1
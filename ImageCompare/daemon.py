@@ -0,0 +1,378 @@
+"""Local comparison daemon shared by the processes of a test run.
+
+Every pabot process would otherwise import OpenCV and build its own reference
+and mask caches. With the ``daemon`` library argument, ``Compare Images``
+sends the comparison to a daemon listening on a Unix domain socket instead.
+The daemon keeps the process-wide caches warm for the whole run and compares
+on a fixed number of worker threads, which bounds the CPU and memory used on
+the host. It is started on demand by the first library which needs it and
+exits after ``idle_timeout`` seconds without requests.
+
+Requests and responses are JSON lines, one request per connection. Images are
+sent as absolute paths, base64 strings or, for numpy arrays and ``bytes``, as
+shared memory segments. The output of each comparison (log messages and
+screenshot links) is captured and relayed to the log by the client.
+
+If the daemon cannot be reached or started, comparisons run in-process.
+
+Only the user running the daemon can connect to its socket. Requests may only
+contain the comparison arguments listed below, options which write files such
+as reference runs or the reference store are never taken from a request.
+
+The daemon can also be started manually::
+
+    python -m ImageCompare.daemon --socket /tmp/imagecompare.sock --workers 8
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent import futures
+
+from . import sources
+from .executor import available_cpus
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+
+START_TIMEOUT = 30
+IDLE_TIMEOUT = 300
+# Seconds a client waits for the result of a comparison before comparing in-process
+COMPARE_TIMEOUT = 120
+# Library arguments, keyword options and variables accepted from requests, all others are ignored or rejected
+LIBRARY_ARGUMENTS = ('threshold', 'DPI', 'take_screenshots', 'show_diff', 'screenshot_format', 'artifact_policy', 'artifact_layout',
+                     'artifact_max_dimension', 'artifact_crop_margin', 'artifact_max_crops', 'engine', 'strategy', 'pyramid_levels',
+                     'pyramid_tile_size', 'pyramid_noise_floor', 'method', 'pixel_tolerance', 'grayscale', 'comparison_scale',
+                     'fail_fast', 'pages_in_flight')
+COMPARISON_OPTIONS = ('placeholder_file', 'mask', 'DPI', 'engine', 'strategy', 'method', 'threshold', 'pixel_tolerance',
+                      'fail_fast', 'pages_in_flight', 'grayscale', 'comparison_scale')
+ROBOT_VARIABLES = ('${PABOTQUEUEINDEX}', '${LOG FILE}', '${OUTPUTDIR}', '${SUITE NAME}', '${TEST NAME}')
+
+
+class _ThreadOutput(object):
+    """``sys.stdout`` replacement which collects the output of each comparison separately."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffers = {}
+        # executor threads of a library write to the buffer of the worker thread owning the library
+        self.owners = {}
+
+    def _buffer(self):
+        ident = threading.get_ident()
+        return self.buffers.get(self.owners.get(ident, ident), self.stream)
+
+    def write(self, text):
+        return self._buffer().write(text)
+
+    def flush(self):
+        self._buffer().flush()
+
+
+class ComparisonDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=None, idle_timeout=IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.workers = int(workers or available_cpus())
+        self.idle_timeout = float(idle_timeout)
+        self.pool = futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ImageCompareDaemon')
+        self.output = _ThreadOutput(sys.stdout)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.active_requests = 0
+        self.last_request = time.monotonic()
+        self.stopped = False
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+    def server_bind(self):
+        # only the user running the daemon may connect, the socket is never accessible to others
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+
+    def serve(self):
+        """Handles requests until shutdown is requested or the daemon was idle for ``idle_timeout`` seconds."""
+        sys.stdout = self.output
+        self.timeout = 1.0
+        try:
+            while not self.stopped:
+                self.handle_request()
+                with self._lock:
+                    idle = self.active_requests == 0 and time.monotonic() - self.last_request > self.idle_timeout
+                if idle:
+                    break
+        finally:
+            sys.stdout = self.output.stream
+            self.pool.shutdown(wait=True)
+            self.server_close()
+
+    def handle(self, request):
+        with self._lock:
+            self.active_requests += 1
+        try:
+            if request.get('command') == 'shutdown':
+                self.stopped = True
+                return {'stopped': True}
+            if request.get('command') == 'ping':
+                return {'workers': self.workers, 'pid': os.getpid()}
+            return self.pool.submit(self.compare, request).result()
+        finally:
+            with self._lock:
+                self.active_requests -= 1
+                self.last_request = time.monotonic()
+
+    def _library(self, library_arguments):
+        """Returns the library instance of this worker thread for ``library_arguments``."""
+        libraries = getattr(self._local, 'libraries', None)
+        if libraries is None:
+            libraries = self._local.libraries = {}
+        # e.g. the reference store and blobs of the client are never used, they write files
+        arguments = {name: value for name, value in library_arguments.items() if name in LIBRARY_ARGUMENTS}
+        key = json.dumps(arguments, sort_keys=True)
+        if key not in libraries:
+            from .imagecompare import ImageCompare
+            # the worker pool bounds the parallelism, every comparison runs single-threaded
+            # the metrics report is written by the client processes
+            library = ImageCompare(**dict(arguments, max_workers=1, metrics_report=None))
+            library._executor = futures.ThreadPoolExecutor(max_workers=1, initializer=_register_executor_thread,
+                                                           initargs=(self.output.owners, threading.get_ident()))
+            libraries[key] = library
+        return libraries[key]
+
+    def compare(self, request):
+        output = io.StringIO()
+        self.output.buffers[threading.get_ident()] = output
+        passed, message = True, ''
+        try:
+            options = request.get('options', {})
+            unsupported = sorted(set(options) - set(COMPARISON_OPTIONS))
+            if unsupported:
+                raise ValueError('Unsupported comparison options: {}'.format(', '.join(unsupported)))
+            library = self._library(request.get('library_arguments', {}))
+            # e.g. ${REFERENCE_RUN} is never taken from a request, reference runs write files
+            library.robot_variables = {name: value for name, value in request.get('robot_variables', {}).items() if name in ROBOT_VARIABLES}
+            library.last_metrics = None
+            try:
+                library.compare_images(_unpack(request['reference']), _unpack(request['candidate']), **options)
+            except AssertionError as error:
+                passed, message = False, str(error)
+            finally:
+                library.flush_artifacts()
+        except Exception as error:
+            # not a comparison failure, the client repeats the comparison in-process to raise it
+            return {'error': '{}: {}'.format(type(error).__name__, error)}
+        finally:
+            del self.output.buffers[threading.get_ident()]
+        metrics = library.last_metrics.as_dict() if library.last_metrics is not None else None
+        return {'passed': passed, 'message': message, 'output': output.getvalue(), 'metrics': metrics}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        self.wfile.write(json.dumps(self.server.handle(request)).encode() + b'\n')
+
+
+def _register_executor_thread(owners, owner):
+    owners[threading.get_ident()] = owner
+
+
+def _pack(image, segments):
+    """Returns ``image`` as JSON value, numpy arrays and bytes are copied to a shared memory segment."""
+    if not sources.is_image_data(image):
+        return os.path.abspath(image)
+    if isinstance(image, str):
+        return image
+    from multiprocessing import shared_memory
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        data = memoryview(image).cast('B')
+        segment = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        segment.buf[:len(data)] = data
+        segments.append(segment)
+        return {'shared_memory': segment.name, 'size': len(data)}
+    array = np.ascontiguousarray(image)
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+    segments.append(segment)
+    return {'shared_memory': segment.name, 'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+
+def _unpack(value):
+    if not isinstance(value, dict):
+        return value
+    from multiprocessing import resource_tracker, shared_memory
+    segment = shared_memory.SharedMemory(name=value['shared_memory'])
+    try:
+        # the client owns the segment, it must not be removed when the daemon exits
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    except Exception:
+        pass
+    try:
+        if 'shape' in value:
+            return np.ndarray(value['shape'], dtype=value['dtype'], buffer=segment.buf).copy()
+        return bytes(segment.buf[:value['size']])
+    finally:
+        segment.close()
+
+
+class DaemonClient(object):
+
+    def __init__(self, socket_path, workers=None, idle_timeout=IDLE_TIMEOUT, start=True, timeout=COMPARE_TIMEOUT):
+        self.socket_path = os.path.abspath(socket_path)
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.start = start
+        # False once the daemon could neither be reached nor started, comparisons then run in-process
+        self.available = hasattr(socket, 'AF_UNIX')
+
+    def request(self, request, timeout=None):
+        """Sends ``request``, a dictionary or its JSON encoding, and returns the response."""
+        payload = request if isinstance(request, bytes) else json.dumps(request).encode()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        try:
+            connection.connect(self.socket_path)
+            connection.sendall(payload + b'\n')
+            with connection.makefile('rb') as f:
+                return json.loads(f.readline())
+        finally:
+            connection.close()
+
+    def _connect(self):
+        try:
+            self.request({'command': 'ping'}, timeout=5)
+            return True
+        except (OSError, ValueError):
+            pass
+        if not self.start:
+            return False
+        self._start_daemon()
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                self.request({'command': 'ping'}, timeout=5)
+                return True
+            except (OSError, ValueError):
+                time.sleep(0.1)
+        return False
+
+    def _start_daemon(self):
+        command = [sys.executable, '-m', 'ImageCompare.daemon', '--socket', self.socket_path, '--idle-timeout', str(self.idle_timeout)]
+        if self.workers:
+            command += ['--workers', str(self.workers)]
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get('PYTHONPATH')])))
+        with open(self.socket_path + '.log', 'ab') as log:
+            subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=log, env=environment, start_new_session=True)
+
+    def _send(self, payload):
+        try:
+            return self.request(payload, timeout=self.timeout)
+        except socket.timeout:
+            raise
+        except (OSError, ValueError):
+            # not started yet, or exited since the last comparison
+            if not self._connect():
+                raise
+            return self.request(payload, timeout=self.timeout)
+
+    def compare(self, reference_image, test_image, options, library_arguments, robot_variables):
+        """Compares the images in the daemon. Returns the response, or None if the daemon is not available."""
+        if not self.available or set(options) - set(COMPARISON_OPTIONS):
+            return None
+        segments = []
+        try:
+            options = dict(options)
+            if options.get('placeholder_file'):
+                options['placeholder_file'] = os.path.abspath(options['placeholder_file'])
+            request = {'reference': _pack(reference_image, segments), 'candidate': _pack(test_image, segments), 'options': options,
+                       'library_arguments': library_arguments, 'robot_variables': robot_variables}
+            try:
+                payload = json.dumps(request).encode()
+            except TypeError:
+                # e.g. Python objects passed as arguments, only possible in-process
+                return None
+            try:
+                return self._send(payload)
+            except socket.timeout:
+                # the daemon is wedged or overloaded, waiting for it again would block every comparison
+                self.available = False
+                print('*WARN* The comparison daemon {} did not respond within {} seconds, comparing in-process'.format(self.socket_path, self.timeout))
+                return None
+            except (OSError, ValueError):
+                self.available = False
+                print('*INFO* The comparison daemon {} is not available, comparing in-process'.format(self.socket_path))
+                return None
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+
+    def shutdown(self):
+        try:
+            self.request({'command': 'shutdown'}, timeout=5)
+        except (OSError, ValueError):
+            pass
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(socket_path, workers=None, idle_timeout=IDLE_TIMEOUT, timeout=COMPARE_TIMEOUT):
+    """Returns the client of ``socket_path``, shared by all library instances of the process."""
+    with _clients_lock:
+        if socket_path not in _clients:
+            _clients[socket_path] = DaemonClient(socket_path, workers=workers, idle_timeout=idle_timeout, timeout=timeout)
+        return _clients[socket_path]
+
+
+def _lock(socket_path):
+    """Returns the lock file of the daemon, or None if another daemon holds it."""
+    import fcntl
+    lock_file = open(socket_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Local ImageCompare comparison daemon')
+    parser.add_argument('--socket', required=True, help='path of the Unix domain socket')
+    parser.add_argument('--workers', type=int, default=None, help='parallel comparisons, default: available CPUs')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, help='seconds without requests after which the daemon exits')
+    options = parser.parse_args(arguments)
+    lock_file = _lock(options.socket)
+    if lock_file is None:
+        # started concurrently by another process
+        return
+    try:
+        if os.path.exists(options.socket):
+            # left behind by a daemon which was killed
+            os.remove(options.socket)
+        ComparisonDaemon(options.socket, workers=options.workers, idle_timeout=options.idle_timeout).serve()
+    finally:
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        lock_file.close()
+
+
+if __name__ == '__main__':
+    main()
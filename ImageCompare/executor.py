@@ -0,0 +1,54 @@
+"""Sizing of the thread pool shared by all comparisons of a library instance."""
+
+import math
+import os
+
+MAX_WORKERS_ENVIRONMENT_VARIABLE = 'IMAGECOMPARE_MAX_WORKERS'
+
+
+def _cgroup_cpu_quota():
+    """Returns the CPU quota of the cgroup of this process as number of CPUs, or None if there is no quota."""
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """Returns the number of CPUs this process may use, respecting CPU affinity and cgroup quotas."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def max_workers(value=None):
+    """Returns the number of worker threads: ``value``, the environment variable or the available CPUs."""
+    if value is None:
+        value = os.environ.get(MAX_WORKERS_ENVIRONMENT_VARIABLE)
+    if value is None or str(value).strip() == '':
+        return available_cpus()
+    value = int(value)
+    if value < 1:
+        raise ValueError('max_workers must be at least 1, got {}'.format(value))
+    return value
@@ -0,0 +1,182 @@
+"""On-disk index of perceptual hashes for finding matching references in large libraries.
+
+The index stores the dHash and pHash of every image of a reference directory
+in a JSON file together with the modification time and size of the image, so
+that it can be updated incrementally. The hashes are kept in ``uint64`` arrays
+and a query computes the Hamming distance to all references at once with XOR
+and popcount, which takes a few milliseconds for tens of thousands of references.
+
+To keep updates cheap for large libraries, only directories whose modification
+time changed are listed again, i.e. directories in which files were added,
+removed or replaced. Files overwritten in place are only found by a full update.
+"""
+
+import json
+import os
+import threading
+
+from .batch import IMAGE_EXTENSIONS
+from .lazy import lazy_import
+from .metrics import dhash, phash
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+HASH_TYPES = {'phash': phash, 'dhash': dhash}
+INDEX_FILE_NAME = '.imagecompare_hashes.json'
+INDEX_VERSION = 2
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def image_hashes(image):
+    """Returns the dHash and pHash of an image file or a decoded image."""
+    if isinstance(image, str):
+        # hashes are computed on a tiny image, the reduced decoding is several times faster
+        gray = cv2.imread(image, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if gray is None:
+            raise AssertionError("No OpenCV Image could be created for file {} . Maybe the file is corrupt?".format(image))
+    else:
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return {hash_type: function(gray) for hash_type, function in HASH_TYPES.items()}
+
+
+def _popcount(values):
+    """Returns the number of set bits of each value of a ``uint64`` array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # numpy < 2.0
+    table = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex(object):
+
+    def __init__(self, directory, index_file=None):
+        self.directory = os.path.abspath(directory)
+        self.index_file = index_file or os.path.join(self.directory, INDEX_FILE_NAME)
+        self.entries = {}
+        # Modification time and subdirectories of each scanned directory, relative to the reference directory
+        self.directories = {}
+        # Relative paths of the entries and their hashes in the same order, see _build_arrays
+        self.paths = []
+        self.hashes = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return
+        with open(self.index_file) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION and index.get('directory') == self.directory:
+            self.entries = index['entries']
+            self.directories = index['directories']
+        self._build_arrays()
+
+    def save(self):
+        index = {'version': INDEX_VERSION, 'directory': self.directory, 'entries': self.entries, 'directories': self.directories}
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        temporary_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(temporary_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary_file, self.index_file)
+
+    def update(self, full=False):
+        """Hashes new and changed images, removes deleted ones and saves the index if anything changed.
+
+        Only directories whose modification time changed are listed, unless ``full`` is true.
+        Returns the number of changed entries.
+        """
+        with self._lock:
+            found, directories = self._scan(full)
+            changes = 0
+            for relative_path in set(self.entries) - set(found):
+                del self.entries[relative_path]
+                changes += 1
+            for relative_path, stat in found.items():
+                if stat is None:
+                    continue
+                mtime, size = stat
+                entry = self.entries.get(relative_path)
+                if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+                    continue
+                hashes = image_hashes(os.path.join(self.directory, relative_path))
+                self.entries[relative_path] = dict({hash_type: format(value, 'x') for hash_type, value in hashes.items()}, mtime=mtime, size=size)
+                changes += 1
+            self.directories = directories
+            if changes:
+                self._build_arrays()
+                self.save()
+                # saving the index changes the modification time of its directory
+                index_directory = os.path.relpath(os.path.dirname(os.path.abspath(self.index_file)), self.directory)
+                if index_directory == '.':
+                    index_directory = ''
+                if index_directory in self.directories:
+                    self.directories[index_directory]['mtime'] = os.stat(os.path.join(self.directory, index_directory)).st_mtime_ns
+            return changes
+
+    def _scan(self, full):
+        """Returns the images found as ``{relative path: (mtime, size)}`` and the scanned directories.
+
+        Images of unchanged directories are not stat-ed, they are returned with None.
+        """
+        files_by_directory = {}
+        for relative_path in self.entries:
+            files_by_directory.setdefault(os.path.dirname(relative_path), []).append(relative_path)
+        found, directories = {}, {}
+        pending = ['']
+        while pending:
+            relative_directory = pending.pop()
+            directory = os.path.join(self.directory, relative_directory)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            known = self.directories.get(relative_directory)
+            if not full and known is not None and known['mtime'] == mtime:
+                # no file was added, removed or replaced in this directory since the last scan
+                subdirectories = known['subdirectories']
+                found.update((relative_path, None) for relative_path in files_by_directory.get(relative_directory, ()))
+            else:
+                subdirectories = []
+                with os.scandir(directory) as items:
+                    for item in items:
+                        relative_path = os.path.join(relative_directory, item.name)
+                        if item.is_dir(follow_symlinks=False):
+                            subdirectories.append(relative_path)
+                        elif item.name.lower().endswith(IMAGE_EXTENSIONS) and item.is_file():
+                            stat = item.stat()
+                            found[relative_path] = (stat.st_mtime_ns, stat.st_size)
+            directories[relative_directory] = {'mtime': mtime, 'subdirectories': subdirectories}
+            pending.extend(subdirectories)
+        return found, directories
+
+    def _build_arrays(self):
+        self.paths = list(self.entries)
+        self.hashes = {hash_type: np.array([int(self.entries[relative_path][hash_type], 16) for relative_path in self.paths], dtype=np.uint64)
+                       for hash_type in HASH_TYPES}
+
+    def query(self, image, max_distance=10, count=None, hash_type='phash'):
+        """Returns ``(path, distance)`` of the references nearest to ``image``, sorted by distance."""
+        if hash_type not in HASH_TYPES:
+            raise ValueError('Unknown hash type "{}". Supported hash types: {}'.format(hash_type, ', '.join(HASH_TYPES)))
+        if not self.paths:
+            return []
+        value = image_hashes(image)[hash_type]
+        distances = _popcount(np.bitwise_xor(self.hashes[hash_type], np.uint64(value)))
+        candidates = np.flatnonzero(distances <= max_distance)
+        matches = sorted((int(distances[i]), self.paths[i]) for i in candidates)
+        if count is not None:
+            matches = matches[:count]
+        return [(os.path.join(self.directory, relative_path), distance) for distance, relative_path in matches]
+
+
+def get_index(directory, index_file=None):
+    """Returns the index of ``directory``, kept in memory for following queries of this process."""
+    key = (os.path.abspath(directory), index_file)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = HashIndex(directory, index_file=index_file)
+        return _indexes[key]
@@ -71,58 +71,286 @@ Compare two PDF Docments and ignore parts by using masks
     }
 ]
 ```
+### Use the OpenCV engine for faster comparisons of large images
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    engine=opencv
+```
+The `opencv` engine computes the same SSIM score as the default `skimage` engine within a tolerance of `1e-4`.
+
+### Reference image cache
+
+Decoded reference images are kept in a process-wide cache, so repeated comparisons against the same reference
+skip decoding and preprocessing. The memory budget is set in MB, `0` disables the cache.
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    reference_cache_size=512
+```
+
+### Memory-mapped reference store
+
+Decoded references can be stored as `.npy` files which are memory-mapped by all processes, e.g. of a pabot run,
+so references are decoded only once and share the OS page cache. Entries are invalidated by the hash of the
+reference file and refreshed when a reference run saves a new reference.
+`reference_store_gray=true` additionally stores the grayscale images.
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    reference_store=${CURDIR}/.reference_store
+```
+
+### Compare in grayscale at a reduced scale
+
+Most comparisons pass, and the metrics only use the grayscale images. With `grayscale=true` the images are
+decoded directly in grayscale, with `comparison_scale=2`, `4` or `8` additionally reduced while decoding.
+The color images are only decoded for screenshots.
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    grayscale=true    comparison_scale=2
+```
+
+### Comparison daemon shared by pabot processes
+
+With `daemon=<socket path>`, comparisons are sent to a local daemon over a Unix domain socket. It is started
+on demand, keeps the reference and mask caches warm for all processes of the run and compares on
+`daemon_workers` threads (default: available CPUs), which bounds the CPU and memory used on the host.
+It exits after `daemon_idle_timeout` seconds (default `300`) without requests.
+If the daemon cannot be started, e.g. on Windows, or does not return a result within `daemon_timeout` seconds
+(default `120`), the comparisons of the process run in-process.
+Only the user who started the daemon can connect to the socket. Reference runs always compare in-process.
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    daemon=/tmp/imagecompare.sock    daemon_workers=8
+```
+
+### Compare many images in parallel processes
+
+```RobotFramework
+*** Test Cases ***
+Compare all screenshots of a run
+    Compare Image Directories    reference_screenshots    candidate_screenshots    workers=8
+```
+
+### Compare screenshots in memory
+
+Images can be passed as numpy arrays, encoded `bytes` or base64 strings instead of files,
+e.g. screenshots returned by Browser or SeleniumLibrary.
+
+```RobotFramework
+*** Test Cases ***
+Compare a screenshot without saving it
+    ${screenshot}=    Take Screenshot    return_as=base64
+    Compare Images    reference.png    ${screenshot}
+```
+
+Outside of Robot Framework, use the Python API:
+
+```python
+from ImageCompare.api import ImageComparator
+
+with ImageComparator(output_directory='results') as comparator:
+    result = comparator.compare('reference.png', screenshot_bytes)
+```
+
+### Timing and metrics of each comparison
+
+`Compare Images` returns the time spent per stage (decoding, masking, grayscale conversion, metric, highlighting
+and screenshots) and counters like bytes read and written. A report of all comparisons is written at the end
+of each suite if `metrics_report` is set, as JSON or CSV depending on the file extension.
+
+```RobotFramework
+*** Settings ***
+Library    ImageCompare    metrics_report=imagecompare_metrics.csv
+```
+
 ## More info will be added soon
 """
 
-from skimage import metrics
-import imutils
-import cv2
 import time
-import shutil
 import os
 import uuid
-import numpy as np
 from pathlib import Path
 from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
-import re
+from collections import deque
 from concurrent import futures
 from robot.api.deco import keyword, library
-import json
-import math
 from .CompareImage import CompareImage
+from .cache import ReferenceCache, ReferenceCacheEntry
+from . import batch
+from .executor import available_cpus, max_workers
+from .artifacts import ArtifactWriter, write_image
+from robot.api import logger
+from robot.output.stdoutlogsplitter import StdoutLogSplitter
+from robot.utils import is_truthy
+from .ssim import check_engine, check_strategy
+from .metrics import get_metric
+from . import hashindex
+from . import pages
+from . import sources
+from .store import ReferenceStore
+from . import references
+from . import daemon
+from . import instrumentation
+from .instrumentation import ComparisonMetrics
+from .lazy import lazy_attribute, lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
 
 @library
 class ImageCompare(object):
 
+    ROBOT_LISTENER_API_VERSION = 3
+
     ROBOT_LIBRARY_VERSION = 0.2
     DPI = 200
-    FONT = cv2.FONT_HERSHEY_SIMPLEX
+    # cv2 is only imported on first use
+    FONT = lazy_attribute(lambda: cv2.FONT_HERSHEY_SIMPLEX)
     BOTTOM_LEFT_CORNER_OF_TEXT = (20,60)
     FONT_SCALE = 0.7
     FONT_COLOR = (255,0,0)
     LINE_TYPE = 2
+    SCREENSHOT_FORMATS = ('jpg', 'png', 'webp')
+    # cv2.imwrite parameters per screenshot format
+    SCREENSHOT_PARAMS = lazy_attribute(lambda: {'jpg': [cv2.IMWRITE_JPEG_QUALITY, 70], 'png': [], 'webp': [cv2.IMWRITE_WEBP_QUALITY, 80]})
     REFERENCE_LABEL = "Expected Result (Reference)"
     CANDIDATE_LABEL = "Actual Result (Candidate)"
+    # Shared by all library instances of the process
+    reference_cache = ReferenceCache()
 
     def __init__(self, **kwargs):
-        self.threshold = kwargs.pop('threshold', 0.0000)
+        self.library_arguments = dict(kwargs)
+        # Values of Robot Framework variables, used instead of the execution context if set (e.g. in batch workers)
+        self.robot_variables = None
+        # Thread pool shared by all comparisons of this instance, created on first use
+        self.max_workers = max_workers(kwargs.pop('max_workers', None))
+        self._executor = None
+        self.ROBOT_LIBRARY_LISTENER = self
+        # Screenshots are encoded and written in background threads unless async_artifacts is false
+        self.async_artifacts = is_truthy(kwargs.pop('async_artifacts', True))
+        self.artifact_flush = kwargs.pop('artifact_flush', 'suite')
+        if self.artifact_flush not in ('keyword', 'suite'):
+            raise ValueError('artifact_flush must be "keyword" or "suite", got "{}"'.format(self.artifact_flush))
+        self.artifact_writer = ArtifactWriter(workers=int(kwargs.pop('artifact_writers', 2)), queue_size=int(kwargs.pop('artifact_queue_size', 8)))
+        self.threshold = float(kwargs.pop('threshold', 0.0000))
         self.SCREENSHOT_DIRECTORY = Path("screenshots/")
         self.DPI = int(kwargs.pop('DPI', 200))
         self.take_screenshots = bool(kwargs.pop('take_screenshots', False))
         self.show_diff = bool(kwargs.pop('show_diff', False))
         self.screenshot_format = kwargs.pop('screenshot_format', 'jpg')
-        if not (self.screenshot_format == 'jpg' or self.screenshot_format == 'png'):
-             self.screenshot_format == 'jpg'
+        if self.screenshot_format not in self.SCREENSHOT_FORMATS:
+             self.screenshot_format = 'jpg'
+        # Artifact policies, see Compare Images
+        self.artifact_policy = kwargs.pop('artifact_policy', 'full')
+        if self.artifact_policy not in ('full', 'crops'):
+            raise ValueError('artifact_policy must be "full" or "crops", got "{}"'.format(self.artifact_policy))
+        self.artifact_layout = kwargs.pop('artifact_layout', 'concat')
+        if self.artifact_layout not in ('concat', 'panels'):
+            raise ValueError('artifact_layout must be "concat" or "panels", got "{}"'.format(self.artifact_layout))
+        self.artifact_max_dimension = int(kwargs.pop('artifact_max_dimension', 0))
+        self.artifact_crop_margin = int(kwargs.pop('artifact_crop_margin', 20))
+        self.artifact_max_crops = int(kwargs.pop('artifact_max_crops', 10))
+        self.engine = check_engine(kwargs.pop('engine', 'skimage'))
+        self.strategy = check_strategy(kwargs.pop('strategy', 'full'))
+        self.pyramid_levels = int(kwargs.pop('pyramid_levels', 2))
+        self.pyramid_tile_size = int(kwargs.pop('pyramid_tile_size', 256))
+        self.pyramid_noise_floor = int(kwargs.pop('pyramid_noise_floor', 0))
+        self.method = get_metric(kwargs.pop('method', 'ssim')).name
+        self.pixel_tolerance = int(kwargs.pop('pixel_tolerance', 0))
+        # Decode the pages in grayscale and/or reduced by comparison_scale, color is only decoded for screenshots
+        self.grayscale = is_truthy(kwargs.pop('grayscale', False))
+        self.comparison_scale = int(kwargs.pop('comparison_scale', 1))
+        if self.comparison_scale not in sources.SCALES:
+            raise ValueError('comparison_scale must be one of 1, 2, 4 or 8, got "{}"'.format(self.comparison_scale))
+        self.fast_path_taken = False
+        self.fail_fast = is_truthy(kwargs.pop('fail_fast', False))
+        self.pages_in_flight = int(kwargs.pop('pages_in_flight', self.max_workers))
+        # Memory budget of the reference cache in MB, 0 disables the cache
+        self.reference_cache.resize(int(float(kwargs.pop('reference_cache_size', 256)) * 1024 * 1024))
+        # Directory of the memory-mapped store of decoded references, disabled by default
+        reference_store = kwargs.pop('reference_store', None)
+        self.reference_store = ReferenceStore(reference_store, gray=is_truthy(kwargs.pop('reference_store_gray', False))) if reference_store else None
+        # Content-addressed directory new references are hard-linked from in reference runs, disabled by default
+        self.reference_blobs = kwargs.pop('reference_blobs', None)
+        # JSON or CSV file the metrics of all comparisons are written to at the end of each suite
+        self.metrics_report = kwargs.pop('metrics_report', None)
+        self.last_metrics = None
+        # Unix domain socket of the comparison daemon, comparisons run in-process by default
+        daemon_socket = kwargs.pop('daemon', None)
+        self.daemon = daemon.get_client(daemon_socket, workers=kwargs.pop('daemon_workers', None),
+                                        idle_timeout=float(kwargs.pop('daemon_idle_timeout', daemon.IDLE_TIMEOUT)),
+                                        timeout=float(kwargs.pop('daemon_timeout', daemon.COMPARE_TIMEOUT))) if daemon_socket else None
     
     @keyword    
     def compare_images(self, reference_image, test_image, **kwargs):
         """Compares the documents/images ``reference_image`` and ``test_image``.
 
-        ``**kwargs`` can be used to add settings for ``placeholder_file``
+        ``**kwargs`` can be used to add settings for ``placeholder_file``, ``method``, ``threshold``, ``engine`` and ``strategy``
+
+        ``method`` selects the comparison metric. Each metric calculates a score per page, the page is
+        different if the score is greater than ``threshold``:
+        | = method = | = score = | = use case = |
+        | ``ssim`` (default) | ``1 - SSIM`` of the grayscale images, between 0 and 1 | Structural comparison, robust against noise |
+        | ``pixel`` | Number of pixels of which any channel differs by more than ``pixel_tolerance`` (default ``0``) | "Fewer than N pixels differ by more than T", fastest |
+        | ``phash`` | Hamming distance of the perceptual hashes, between 0 and 64 | Coarse similarity, ignores small details |
+        | ``histogram`` | ``1 - correlation`` of the grayscale histograms, between 0 and 2 | Brightness and color distribution, ignores layout |
+        All metrics use the same highlighting and logging of differences. Default ``method``, ``threshold`` and
+        ``pixel_tolerance`` can be set when importing the library.
+        
+        ``engine`` selects the SSIM implementation. ``skimage`` (default) uses ``skimage.metrics.structural_similarity``,
+        ``opencv`` computes the same Gaussian-windowed SSIM with OpenCV in float32. It is considerably faster for
+        large images and its score stays within ``1e-4`` of the ``skimage`` score, so the same ``threshold`` applies.
+        The default engine can also be set when importing the library.
+
+        ``strategy`` selects how the SSIM is computed. ``full`` (default) computes it for the whole image.
+        ``pyramid`` computes the full resolution SSIM only for tiles which contain differences, found on a
+        downscaled map of the changed pixels, so the cost of the SSIM scales with the changed area instead of the image size.
+        The number of ``pyramid_levels`` (default ``2``), the ``pyramid_tile_size`` (default ``256``) and
+        the ``pyramid_noise_floor`` (default ``0``) can be set when importing the library.
+        Pixels which differ by at most the noise floor are ignored, with the default ``0`` no difference is missed.
         
         Result is passed if no visual differences are detected. 
+
+        Screenshots are written to the log directory in background threads. The log entry is created immediately,
+        the files are complete at the end of the suite (``artifact_flush=suite``, default) or at the end of the keyword
+        (``artifact_flush=keyword``). Set ``async_artifacts=false`` when importing the library to write them synchronously.
+
+        The size of the screenshots is controlled with these arguments when importing the library:
+        | = argument = | = default = | = effect = |
+        | ``screenshot_format`` | ``jpg`` | ``jpg``, ``png`` or ``webp`` |
+        | ``artifact_max_dimension`` | ``0`` | Screenshots are downscaled so that neither side exceeds this number of pixels, ``0`` keeps the full resolution |
+        | ``artifact_policy`` | ``full`` | ``full`` logs the whole pages with highlighted differences. ``crops`` logs only crops around the ``artifact_max_crops`` (default ``10``) largest differences, extended by ``artifact_crop_margin`` (default ``20``) pixels, so the log size depends on the size of the differences instead of the pages |
+        | ``artifact_layout`` | ``concat`` | ``concat`` writes reference and candidate side by side as one image. ``panels`` writes them as separate images, shown side by side in the log |
         
         ``reference_image`` and ``test_image`` may be image files, e.g. png, jpg, or tiff.
+        They may also be passed as data, which is decoded in memory without temporary files: numpy arrays
+        (BGR, BGRA or grayscale, 8 bit), encoded image files as ``bytes`` or base64 strings, optionally as
+        ``data:image/png;base64,...`` URI, e.g. screenshots returned by Browser or SeleniumLibrary.
+
+        If the variable ``${REFERENCE_RUN}`` is true, the candidate is saved as new ``reference_image`` instead of
+        being compared, also if it is passed as data. The reference is written to a temporary file and renamed, so
+        parallel processes never read a partially written reference, and it is not written at all if its content
+        is unchanged. With the ``reference_blobs`` directory given when importing the library, each distinct
+        content is stored once in that directory and the references are hard links to it.
+
+        Multi-page documents, i.e. multi-page TIFF files or directories of page images (sorted in natural order,
+        ``page2.png`` before ``page10.png``), are decoded page by page while the pages are compared. At most
+        ``pages_in_flight`` pages (default: the ``max_workers`` of the library) are held in memory and compared at a time.
+        With ``fail_fast=${true}`` no further pages are decoded and compared once a page is different.
+        Both can also be set when importing the library.
+
+        With ``grayscale=${true}`` the pages are decoded directly in grayscale, and with ``comparison_scale`` ``2``, ``4``
+        or ``8`` reduced by that factor while decoding, e.g. JPEG files are only partially decompressed. This saves
+        decoding time and memory, especially if most comparisons pass. Placeholders are defined in full resolution
+        pixels as usual. Screenshots are taken from the pages decoded again in color at full resolution, only when
+        they are logged. Page sizes are compared at the comparison scale, and the reference store is not used.
+        Both can also be set when importing the library.
+
+        Returns the metrics of the comparison, see `Get Comparison Metrics`.
 
 
         Examples:
@@ -131,11 +359,56 @@ class ImageCompare(object):
         | Compare Images | reference.png (not existing)  | candidate.png |              | #Will always return passed and save the candidate.pdf as reference.pdf |
         | Compare Images | reference.png | candidate.png | placeholder_file=mask.json   | #Performs a pixel comparison of both files and excludes some areas defined in mask.json |
         | Compare Images | reference.pdf | candidate.pdf | contains_barcodes=${true}    | #Identified barcodes in documents and excludes those areas from visual comparison. The barcode data will be checked instead |
+        | Compare Images | reference.png | candidate.png | engine=opencv                | #Computes the SSIM with the faster OpenCV engine |
+        | Compare Images | reference.png | candidate.png | strategy=pyramid             | #Computes the SSIM only for tiles of the image which contain differences |
+        | Compare Images | reference.png | candidate.png | method=pixel | threshold=100 | #Passes if at most 100 pixels differ |
+        | Compare Images | reference.tiff | candidate.tiff | fail_fast=${true}          | #Stops at the first different page of the multi-page TIFF files |
+        | Compare Images | reference.png | candidate.png | grayscale=${true} | comparison_scale=2 | #Compares the grayscale images at half the resolution |
+        | Compare Images | reference.png | ${screenshot_base64} |                       | #Compares a base64 encoded screenshot without writing it to disk |
                 
         """
-        #print("Execute comparison")
-        #print('Resolution for image comparison is: {}'.format(self.DPI))
+        if self.daemon is not None:
+            result = self._compare_in_daemon(reference_image, test_image, kwargs)
+            if result is not None:
+                return result
+        metrics = ComparisonMetrics(sources.describe(reference_image), sources.describe(test_image), suite=self._get_variable_value('${SUITE NAME}'),
+                                    test=self._get_variable_value('${TEST NAME}'))
+        self.last_metrics = metrics
+        try:
+            self._compare_images(reference_image, test_image, metrics, **kwargs)
+            metrics.finish('PASS')
+        except BaseException:
+            metrics.finish('FAIL')
+            raise
+        finally:
+            if self.metrics_report:
+                instrumentation.add_record(metrics)
+            if self.artifact_flush == 'keyword':
+                self.flush_artifacts()
+            print(f"Visual Image comparison performed in {metrics.total:0.4f} seconds ({metrics.summary()})")
+        return metrics.as_dict()
 
+    def _compare_in_daemon(self, reference_image, test_image, kwargs):
+        """Compares the images in the comparison daemon. Returns None if they have to be compared in-process."""
+        if is_truthy(self._get_variable_value('${REFERENCE_RUN}', False)):
+            # reference runs write files, the daemon never does
+            return None
+        response = self.daemon.compare(reference_image, test_image, kwargs, self.library_arguments, self._robot_variables())
+        if response is None or 'error' in response:
+            return None
+        for message in StdoutLogSplitter(response['output']):
+            logger.write(message.message, message.level, message.html)
+        if response['metrics'] is not None:
+            metrics = dict(response['metrics'], daemon=True)
+            if self.metrics_report:
+                instrumentation.add_record(metrics)
+            self.last_metrics = instrumentation.RecordedMetrics(metrics)
+        if not response['passed']:
+            raise AssertionError(response['message'])
+        return self.last_metrics.as_dict()
+
+    def _compare_images(self, reference_image, test_image, metrics, **kwargs):
+        reference_image, test_image = sources.decode_base64(reference_image), sources.decode_base64(test_image)
         reference_collection = []
         compare_collection = []
         detected_differences = []
@@ -143,54 +416,157 @@ class ImageCompare(object):
         placeholder_file = kwargs.pop('placeholder_file', None)
         mask = kwargs.pop('mask', None)
         self.DPI = int(kwargs.pop('DPI', self.DPI))
-        reference_run = BuiltIn().get_variable_value('${REFERENCE_RUN}', False)
+        engine = check_engine(kwargs.pop('engine', self.engine))
+        strategy = check_strategy(kwargs.pop('strategy', self.strategy))
+        method = get_metric(kwargs.pop('method', self.method)).name
+        threshold = float(kwargs.pop('threshold', self.threshold))
+        pixel_tolerance = int(kwargs.pop('pixel_tolerance', self.pixel_tolerance))
+        fail_fast = is_truthy(kwargs.pop('fail_fast', self.fail_fast))
+        pages_in_flight = int(kwargs.pop('pages_in_flight', self.pages_in_flight))
+        grayscale = is_truthy(kwargs.pop('grayscale', self.grayscale))
+        comparison_scale = int(kwargs.pop('comparison_scale', self.comparison_scale))
+        reference_run = self._get_variable_value('${REFERENCE_RUN}', False)
+        metrics.context.update(method=method, engine=engine, strategy=strategy)
+        options = dict(engine=engine, strategy=strategy, method=method, threshold=threshold, pixel_tolerance=pixel_tolerance, metrics=metrics)
+        # None decodes in color at full resolution, as before
+        flags = sources.decode_flags(grayscale, comparison_scale) if grayscale or comparison_scale != 1 else None
+        if flags is not None:
+            metrics.context.update(grayscale=grayscale, comparison_scale=comparison_scale)
+            # screenshots are rendered from the color pages, decoded again only if needed
+            options.update(scale=comparison_scale, color_sources=(reference_image, test_image))
+
+        reference_is_data, candidate_is_data = sources.is_image_data(reference_image), sources.is_image_data(test_image)
 
-        if reference_run and (os.path.isfile(test_image) == True):
-            shutil.copyfile(test_image, reference_image)
-            print('A new reference file was saved: {}'.format(reference_image))
+        if reference_run and not candidate_is_data and os.path.isdir(test_image):
+            written = references.save_reference_directory(test_image, reference_image, blob_directory=self.reference_blobs)
+            metrics.count('reference_saved', written)
+            print('The reference directory was saved: {} ({} files changed)'.format(reference_image, written))
+            return
+
+        if reference_run and not reference_is_data and (candidate_is_data or os.path.isfile(test_image)):
+            if references.save_reference(test_image, reference_image, blob_directory=self.reference_blobs):
+                self.reference_cache.invalidate(reference_image)
+                self._refresh_reference_store(reference_image)
+                metrics.count('reference_saved')
+                print('A new reference file was saved: {}'.format(reference_image))
+            else:
+                metrics.count('reference_unchanged')
+                print('The reference file is unchanged: {}'.format(reference_image))
             return
             
-        if (os.path.isfile(reference_image) is False):
+        if not reference_is_data and (os.path.exists(reference_image) is False):
             raise AssertionError('The reference file does not exist: {}'.format(reference_image))
 
-        if (os.path.isfile(test_image) is False):
+        if not candidate_is_data and (os.path.exists(test_image) is False):
             raise AssertionError('The candidate file does not exist: {}'.format(test_image))
 
-        with futures.ThreadPoolExecutor(max_workers=2) as parallel_executor:
-            reference_future = parallel_executor.submit(CompareImage, reference_image, placeholder_file=placeholder_file, DPI=self.DPI, mask=mask)
-            candidate_future = parallel_executor.submit(CompareImage, test_image, DPI=self.DPI)
-            reference_compare_image = reference_future.result()
-            candidate_compare_image = candidate_future.result()
+        # checked once, a comparison without the masks would report the masked areas as differences
+        if placeholder_file is not None and not os.path.isfile(placeholder_file):
+            raise AssertionError('The placeholder file does not exist: {}'.format(placeholder_file))
+
+        if not (reference_is_data or candidate_is_data) and (pages.is_multi_page(reference_image) or pages.is_multi_page(test_image)):
+            self.fast_path_taken = False
+            self._compare_documents(reference_image, test_image, placeholder_file, mask, detected_differences, fail_fast, pages_in_flight, flags, **options)
+            self._check_detected_differences(detected_differences)
+            return
+
+        reference_future = self.executor.submit(self.load_reference, reference_image, placeholder_file=placeholder_file, mask=mask, metrics=metrics, flags=flags)
+        candidate_future = self.executor.submit(self.load_candidate, test_image, metrics=metrics, flags=flags)
+        reference_entry = reference_future.result()
+        candidate_compare_image = candidate_future.result()
         
-        tic = time.perf_counter()
-        if reference_compare_image.placeholders != []:
-            candidate_compare_image.placeholders = reference_compare_image.placeholders
-            with futures.ThreadPoolExecutor(max_workers=2) as parallel_executor:
-                reference_collection_future = parallel_executor.submit(reference_compare_image.get_image_with_placeholders)
-                compare_collection_future = parallel_executor.submit(candidate_compare_image.get_image_with_placeholders)
-                reference_collection = reference_collection_future.result()
-                compare_collection = compare_collection_future.result()
-        else:
-            reference_collection = reference_compare_image.opencv_images
-            compare_collection = candidate_compare_image.opencv_images
+        # Placeholders are not painted into the images, the compiled masks exclude them from the comparison
+        reference_collection = reference_entry.opencv_images
+        compare_collection = candidate_compare_image.opencv_images
+        masks = reference_entry.masks
 
         if len(reference_collection)!=len(compare_collection):
             print("Pages in reference file:{}. Pages in candidate file:{}".format(len(reference_collection), len(compare_collection)))
             for i in range(len(reference_collection)):
-                cv2.putText(reference_collection[i],self.REFERENCE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
-                self.add_screenshot_to_log(reference_collection[i], "_reference_page_" + str(i+1))
+                reference_page = reference_collection[i].copy() if flags is None else pages.decode_page(reference_image, i)
+                cv2.putText(reference_page,self.REFERENCE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
+                self.add_screenshot_to_log(reference_page, "_reference_page_" + str(i+1), metrics=metrics)
             for i in range(len(compare_collection)):
-                cv2.putText(compare_collection[i],self.CANDIDATE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
-                self.add_screenshot_to_log(compare_collection[i], "_candidate_page_" + str(i+1))
+                candidate_page = compare_collection[i] if flags is None else pages.decode_page(test_image, i)
+                cv2.putText(candidate_page,self.CANDIDATE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
+                self.add_screenshot_to_log(candidate_page, "_candidate_page_" + str(i+1), metrics=metrics)
             raise AssertionError('Reference File and Candidate File have different number of pages')
-        
-        check_difference_results = []
-        with futures.ThreadPoolExecutor(max_workers=8) as parallel_executor:
-            for i, (reference, candidate) in enumerate(zip(reference_collection, compare_collection)):
-                check_difference_results.append(parallel_executor.submit(self.check_for_differences, reference, candidate, i, detected_differences))
-        for result in check_difference_results:
-            if result.exception() is not None:
-                raise result.exception()
+
+        if all(self.images_are_identical(reference, candidate, mask) for reference, candidate, mask in zip(reference_collection, compare_collection, masks)):
+            # Fast path: pixel-identical images do not need a grayscale conversion and SSIM
+            self.fast_path_taken = True
+            metrics.count('fast_path')
+            metrics.count('pixels', sum(reference.shape[0] * reference.shape[1] for reference in reference_collection))
+            if self.take_screenshots:
+                for i, (reference, candidate, mask) in enumerate(zip(reference_collection, compare_collection, masks)):
+                    reference, candidate, mask = self._color_pages(reference, candidate, mask, i, options.get('color_sources'), metrics)
+                    self.add_screenshot_to_log([self.paint_mask(reference, mask), self.paint_mask(candidate, mask)], "_page_" + str(i+1) + "_compare_concat", metrics=metrics)
+            print("The compared images are pixel-identical, SSIM was skipped")
+            print("The compared images are equal")
+            return
+        self.fast_path_taken = False
+
+        page_pairs = ((i, reference, candidate, masks[i]) for i, (reference, candidate) in enumerate(zip(reference_collection, compare_collection)))
+        self._compare_pages(page_pairs, detected_differences, fail_fast, pages_in_flight, reference_entry=reference_entry, **options)
+        self._check_detected_differences(detected_differences)
+
+    def _compare_documents(self, reference_image, test_image, placeholder_file, mask, detected_differences, fail_fast, pages_in_flight, flags=None, **options):
+        """Compares multi-page documents page by page while they are decoded."""
+        metrics = options['metrics']
+        reference_page_count, candidate_page_count = pages.page_count(reference_image), pages.page_count(test_image)
+        if reference_page_count != candidate_page_count:
+            print("Pages in reference file:{}. Pages in candidate file:{}".format(reference_page_count, candidate_page_count))
+            raise AssertionError('Reference File and Candidate File have different number of pages')
+        # only the placeholder definitions, the pages are decoded by iter_pages
+        reference_document = CompareImage(reference_image, placeholder_file=placeholder_file, mask=mask, DPI=self.DPI, load=False, flags=flags)
+        metrics.count('bytes_read', pages.document_size(reference_image) + pages.document_size(test_image))
+        page_pairs = self._decode_page_pairs(reference_document, test_image, reference_page_count, metrics)
+        self._compare_pages(page_pairs, detected_differences, fail_fast, pages_in_flight, **options)
+
+    def _decode_page_pairs(self, reference_document, test_image, page_count, metrics):
+        reference_pages = pages.iter_pages(reference_document.image, reference_document.flags)
+        candidate_pages = pages.iter_pages(test_image, reference_document.flags)
+        first_shape = None
+        try:
+            for i in range(page_count):
+                with metrics.stage('decode', page=i):
+                    reference = next(reference_pages)
+                    candidate = next(candidate_pages)
+                first_shape = first_shape or reference.shape
+                with metrics.stage('masking', page=i):
+                    placeholders = reference_document.page_placeholders(i + 1, lambda page: first_shape if page == 'all' else reference.shape)
+                    mask = reference_document.get_comparison_mask(i, shape=reference.shape, placeholders=placeholders)
+                yield i, reference, candidate, mask
+        finally:
+            reference_pages.close()
+            candidate_pages.close()
+
+    def _compare_pages(self, page_pairs, detected_differences, fail_fast=False, pages_in_flight=None, **options):
+        """Compares the ``(page, reference, candidate, mask)`` tuples of ``page_pairs`` in the executor.
+
+        At most ``pages_in_flight`` pages are compared at a time, so a generator of decoded pages is only
+        advanced as fast as the pages are compared. With ``fail_fast`` no further pages are taken once a page is different.
+        """
+        pages_in_flight = max(int(pages_in_flight or self.max_workers), 1)
+        metrics = options.get('metrics') or ComparisonMetrics()
+        in_flight = deque()
+        try:
+            for i, reference, candidate, mask in page_pairs:
+                metrics.count('pages')
+                in_flight.append(self.executor.submit(self.check_for_differences, reference, candidate, i, detected_differences, mask=mask, **options))
+                if len(in_flight) >= pages_in_flight:
+                    in_flight.popleft().result()
+                if fail_fast and detected_differences:
+                    print("Page {} is different, the remaining pages are not compared (fail_fast)".format(i+1))
+                    break
+        finally:
+            if hasattr(page_pairs, 'close'):
+                page_pairs.close()
+            futures.wait(in_flight)
+        for result in in_flight:
+            result.result()
+
+    def _check_detected_differences(self, detected_differences):
         for difference in detected_differences:
 
             if (difference):
@@ -199,17 +575,275 @@ class ImageCompare(object):
 
         print("The compared images are equal")
 
+    @keyword
+    def compare_image_directories(self, reference_directory, candidate_directory, workers=None, **kwargs):
+        """Compares all images in ``reference_directory`` with the images of the same name in ``candidate_directory``.
+
+        Images are matched by their path relative to the directories. An image which exists in only one of the
+        directories is reported as a failed comparison.
+
+        See `Compare Images In Batch` for ``workers`` and ``**kwargs``.
+
+        Examples:
+        | Compare Image Directories | reference_screenshots | candidate_screenshots |
+        | Compare Image Directories | reference_screenshots | candidate_screenshots | workers=4 | placeholder_file=mask.json |
+        """
+        pairs = batch.collect_pairs_from_directories(reference_directory, candidate_directory)
+        return self.compare_images_in_batch(pairs, workers=workers, **kwargs)
+
+    @keyword
+    def compare_images_in_batch(self, pairs, workers=None, **kwargs):
+        """Compares many pairs of images in parallel worker processes.
+
+        ``pairs`` is either a list of ``[reference_image, test_image]`` pairs or the path of a manifest file.
+        A JSON manifest contains a list of pairs or a list of objects with ``reference`` and ``candidate`` keys,
+        a CSV manifest contains one pair per row. Relative paths in a manifest are relative to the manifest file.
+
+        The pairs are compared with `Compare Images` in ``workers`` processes (default: number of available CPUs),
+        using the settings this library was imported with. Each worker process compares with a single thread. ``**kwargs`` are passed to each `Compare Images` call.
+
+        The result of each comparison is logged as soon as it is finished, followed by a summary table.
+        Fails if any comparison failed. Returns a list with one dictionary per pair containing
+        ``reference``, ``candidate``, ``passed``, ``message``, ``duration`` and the ``metrics`` of the comparison (see `Get Comparison Metrics`).
+
+        Examples:
+        | Compare Images In Batch | ${pairs} |
+        | Compare Images In Batch | manifest.json | workers=8 | placeholder_file=mask.json |
+        """
+        pairs = batch.read_manifest(pairs)
+        workers = int(workers) if workers is not None else available_cpus()
+        tic = time.perf_counter()
+        results = batch.run_batch(self.library_arguments, self._robot_variables(), pairs, kwargs, workers)
+        toc = time.perf_counter()
+        failed = batch.log_summary(results)
+        print(f"{len(results)} image comparisons performed in {toc - tic:0.4f} seconds with {workers} workers")
+        for result in results:
+            del result['output']
+            if result['metrics'] is not None and self.metrics_report:
+                # the report of this process also contains the comparisons of the worker processes
+                instrumentation.add_record(result['metrics'])
+        if failed:
+            raise AssertionError('{} of {} image comparisons failed.'.format(failed, len(results)))
+        return results
+
+    @keyword
+    def find_matching_reference(self, candidate_image, reference_directory, max_distance=10, count=5, confirm=False, index_file=None, hash_type='phash', update=True, **kwargs):
+        """Finds the references in ``reference_directory`` which look most similar to ``candidate_image``.
+
+        The perceptual hashes of all images in ``reference_directory`` (including subdirectories) are kept in an
+        index file, by default ``.imagecompare_hashes.json`` in ``reference_directory``. Before each search the
+        index is updated for new, changed and deleted images, so only those are decoded.
+
+        ``update`` controls the cost of this update:
+        | = update = | = effect = |
+        | ``${True}`` (default) | Only directories whose modification time changed are listed, i.e. in which files were added, removed or replaced. Costs one ``stat`` per directory |
+        | ``full`` | All images are checked, also for files overwritten in place. Costs one ``stat`` per image, e.g. about 250 ms for 20000 references |
+        | ``${False}`` | An existing index is not updated, e.g. for many searches while the references do not change. The search itself takes a few milliseconds |
+
+        Returns up to ``count`` matches with a Hamming distance of at most ``max_distance`` (0-64) between the hashes,
+        nearest first. Each match is a dictionary with ``reference`` and ``distance``.
+        ``hash_type`` is ``phash`` (default) or ``dhash``.
+
+        Fails if no reference is within ``max_distance``. If ``confirm`` is true, the best match is additionally compared
+        with `Compare Images`, ``**kwargs`` are passed to it.
+
+        Examples:
+        | ${matches}= | Find Matching Reference | candidate.png | references |
+        | ${matches}= | Find Matching Reference | candidate.png | references | max_distance=4 | count=1 | confirm=${true} | placeholder_file=mask.json |
+        | ${matches}= | Find Matching Reference | candidate.png | references | update=${false} |
+        """
+        tic = time.perf_counter()
+        index = hashindex.get_index(reference_directory, index_file=index_file)
+        changes = 0
+        # an index which was never scanned is always built
+        if is_truthy(update) or not index.directories:
+            changes = index.update(full=str(update).lower() == 'full')
+        matches = index.query(candidate_image, max_distance=int(max_distance), count=int(count), hash_type=hash_type)
         toc = time.perf_counter()
-        print(f"Visual Image comparison performed in {toc - tic:0.4f} seconds")
+        print(f"Index of {len(index.entries)} references ({changes} updated) searched in {toc - tic:0.4f} seconds")
+        if not matches:
+            raise AssertionError('No reference within a distance of {} found for {}'.format(max_distance, candidate_image))
+        for reference, distance in matches:
+            print('Matching reference {} with distance {}'.format(reference, distance))
+        if is_truthy(confirm):
+            self.compare_images(matches[0][0], candidate_image, **kwargs)
+        return [{'reference': reference, 'distance': distance} for reference, distance in matches]
+
+    @property
+    def executor(self):
+        """Thread pool shared by all comparisons of this library instance.
+
+        Its size is set with the ``max_workers`` library argument or the ``IMAGECOMPARE_MAX_WORKERS``
+        environment variable and defaults to the number of CPUs available to the process (respecting CPU quotas).
+        Tasks submitted to this executor must not submit further tasks to it and wait for them.
+        """
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ImageCompare')
+        return self._executor
+
+    def end_suite(self, data, result):
+        """Listener method, writes all queued screenshots and the metrics report at the end of each suite."""
+        self.flush_artifacts()
+        if self.metrics_report:
+            instrumentation.write_report(self.metrics_report_path)
+
+    @property
+    def metrics_report_path(self):
+        PABOTQUEUEINDEX = self._get_variable_value('${PABOTQUEUEINDEX}', None)
+        path = os.path.join(self.log_dir, self.metrics_report)
+        if PABOTQUEUEINDEX is None:
+            return path
+        # every pabot process writes its own report
+        root, extension = os.path.splitext(path)
+        return '{}-{}{}'.format(root, PABOTQUEUEINDEX, extension)
+
+    def close(self):
+        """Listener method called when the library goes out of scope, shuts down the shared executor and writer threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for error in self.artifact_writer.close():
+            logger.warn(error)
+
+    def load_reference(self, reference_image, placeholder_file=None, mask=None, metrics=None, flags=None):
+        """Returns the ``ReferenceCacheEntry`` of ``reference_image``, from the reference cache if possible."""
+        metrics = metrics or ComparisonMetrics()
+        key = None
+        # only files are cached, images passed as data are usually compared once
+        if self.reference_cache.enabled and not sources.is_image_data(reference_image):
+            key = self.reference_cache.key(reference_image, placeholder_file=placeholder_file, mask=mask, DPI=self.DPI, flags=flags)
+            reference_entry = self.reference_cache.get(key)
+            if reference_entry is not None:
+                metrics.count('cache_hits')
+                return reference_entry
+            metrics.count('cache_misses')
+        stored = None
+        # the store holds the pages decoded in color at full resolution
+        use_store = self.reference_store is not None and flags is None and not sources.is_image_data(reference_image)
+        with metrics.stage('decode'):
+            if use_store:
+                stored = self.reference_store.load(reference_image)
+                metrics.count('store_hits' if stored is not None else 'store_misses')
+            if stored is not None:
+                compare_image = CompareImage(reference_image, placeholder_file=placeholder_file, DPI=self.DPI, mask=mask, images=stored[0])
+            else:
+                compare_image = CompareImage(reference_image, placeholder_file=placeholder_file, DPI=self.DPI, mask=mask, flags=flags)
+                metrics.count('bytes_read', sources.size(reference_image))
+        if stored is None and use_store:
+            self.reference_store.add(reference_image, compare_image.opencv_images)
+        with metrics.stage('masking'):
+            reference_entry = ReferenceCacheEntry(compare_image, gray_images=stored[1] if stored is not None else None)
+        if key is not None:
+            self.reference_cache.put(key, reference_entry)
+        return reference_entry
+
+    def _refresh_reference_store(self, reference_image):
+        if self.reference_store is not None:
+            self.reference_store.refresh(reference_image)
+
+    def load_candidate(self, test_image, metrics=None, flags=None):
+        metrics = metrics or ComparisonMetrics()
+        with metrics.stage('decode'):
+            compare_image = CompareImage(test_image, DPI=self.DPI, flags=flags)
+        metrics.count('bytes_read', sources.size(test_image))
+        return compare_image
+
+    @keyword
+    def get_comparison_metrics(self):
+        """Returns the metrics of the last `Compare Images` call of this library instance as a dictionary.
+
+        The dictionary contains ``reference``, ``candidate``, ``result``, the ``total`` duration in seconds and
+        the used ``method``, ``engine`` and ``strategy``. ``stages`` contains the seconds spent per stage in total,
+        ``pages`` per page:
+        | = stage = | = time spent = |
+        | ``decode`` | Reading and decoding the reference and candidate files |
+        | ``masking`` | Compiling the masks of placeholders, only if the reference is not cached |
+        | ``gray`` | Converting the images to grayscale |
+        | ``metric`` | Computing the comparison metric |
+        | ``highlighting`` | Finding and highlighting the differences |
+        | ``artifacts`` | Adding screenshots to the log, i.e. queueing them for the background writer |
+        | ``artifact_write`` | Encoding and writing screenshots, in the background if ``async_artifacts`` is true |
+        ``counters`` contains ``bytes_read``, ``bytes_written``, the number of compared ``pixels``, the reference
+        ``cache_hits`` and ``cache_misses`` and ``fast_path`` if the images were pixel-identical.
+        Stages which were not executed and counters which are zero are omitted.
+        ``bytes_written`` of screenshots written in the background is complete once they are flushed.
+
+        The metrics of all comparisons are written to the ``metrics_report`` file given when importing the library
+        at the end of each suite, as JSON or, if the file name ends with ``.csv``, as CSV with one row per comparison.
+        The path is relative to the log directory. When running with pabot, the pabot queue index is appended to the file name.
+
+        Python code can register a hook which is called at the end of every stage with
+        ``ImageCompare.instrumentation.add_hook(hook)``, see the module documentation.
+
+        Examples:
+        | Compare Images | reference.png | candidate.png |
+        | ${metrics}= | Get Comparison Metrics |
+        | Should Be True | ${metrics}[stages][metric] < 1 |
+        """
+        if self.last_metrics is None:
+            raise AssertionError('No images have been compared yet.')
+        return self.last_metrics.as_dict()
+
+    @keyword
+    def get_reference_cache_statistics(self):
+        """Returns the statistics of the process-wide reference image cache as a dictionary.
+
+        The dictionary contains the number of cache ``hits``, ``misses`` and ``evictions``, the number of cached
+        ``entries``, the current ``size`` and the ``max_size`` of the cache in bytes.
+
+        The memory budget of the cache is set with the ``reference_cache_size`` library argument in MB (default ``256``).
+        A size of ``0`` disables the cache.
+        Cache entries are identified by path, modification time and size of the reference file and by the used mask.
+
+        Examples:
+        | ${statistics}= | Get Reference Cache Statistics |
+        | Should Be True | ${statistics}[hits] > 0 |
+        """
+        return self.reference_cache.statistics()
+
+    @keyword
+    def clear_reference_cache(self):
+        """Removes all entries from the process-wide reference image cache."""
+        self.reference_cache.clear()
+
+    def images_are_identical(self, reference, candidate, mask=None):
+        # cv2.norm releases the GIL and does not allocate a comparison array
+        if reference.shape != candidate.shape or reference.dtype != candidate.dtype:
+            return False
+        return cv2.norm(reference, candidate, cv2.NORM_INF, mask=mask) == 0
+
+    def _color_pages(self, reference, candidate, mask, i, color_sources, metrics):
+        """Returns page ``i`` decoded in color at full resolution for screenshots, if the pages were compared in grayscale or reduced."""
+        if color_sources is None:
+            return reference, candidate, mask
+        with metrics.stage('decode', page=i):
+            reference, candidate = (pages.decode_page(source, i) for source in color_sources)
+        if mask is not None and mask.shape != reference.shape[:2]:
+            mask = cv2.resize(mask, (reference.shape[1], reference.shape[0]), interpolation=cv2.INTER_NEAREST)
+        return reference, candidate, mask
+
+    def _crop_to_common_size(self, reference, candidate, mask=None):
+        height, width = min(reference.shape[0], candidate.shape[0]), min(reference.shape[1], candidate.shape[1])
+        if mask is not None:
+            mask = mask[:height, :width]
+        return reference[:height, :width], candidate[:height, :width], mask
+
+    def paint_mask(self, image, mask):
+        """Returns a copy of ``image`` with the areas excluded by ``mask`` painted blue, as shown in the log."""
+        if mask is None:
+            return image
+        painted = image.copy()
+        painted[mask == 0] = (255, 0, 0)
+        return painted
 
     def get_images_with_highlighted_differences(self, thresh, reference, candidate, extension=10):
         
         #thresh = cv2.dilate(thresh, None, iterations=extension)
         thresh = cv2.dilate(thresh, None, iterations=extension)
         thresh = cv2.erode(thresh, None, iterations=extension)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 2 and 4+ (contours, hierarchy)
         cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
+            cv2.CHAIN_APPROX_SIMPLE)[-2]
 
         # loop over the contours
         for c in cnts:
@@ -221,40 +855,85 @@ class ImageCompare(object):
             cv2.rectangle(candidate, (x, y), (x + w, y + h), (0, 0, 255), 4)
         return reference, candidate, cnts
 
+    def get_difference_crops(self, cnts, shape):
+        """Returns ``(x0, y0, x1, y1)`` of the ``artifact_max_crops`` largest contours, extended by ``artifact_crop_margin``."""
+        rectangles = sorted((cv2.boundingRect(c) for c in cnts), key=lambda rectangle: rectangle[2] * rectangle[3], reverse=True)
+        if len(rectangles) > self.artifact_max_crops:
+            print('{} differences found, the {} largest are logged'.format(len(rectangles), self.artifact_max_crops))
+        margin = self.artifact_crop_margin
+        height, width = shape[:2]
+        return [(max(x - margin, 0), max(y - margin, 0), min(x + w + margin, width), min(y + h + margin, height))
+                for (x, y, w, h) in rectangles[:self.artifact_max_crops]]
+
     def get_diff_rectangle(self, thresh):
         points = cv2.findNonZero(thresh)
         (x, y, w, h) = cv2.boundingRect(points)
         return x, y, w, h
 
-    def add_screenshot_to_log(self, image, suffix):
+    def add_screenshot_to_log(self, image, suffix, metrics=None):
+        """Writes ``image`` to the screenshot directory and embeds it in the log.
+
+        ``image`` may be a list of panels of the same height, which are written side by side as one image
+        or, with ``artifact_layout=panels``, as separate images without concatenating them.
+        """
+        panels = list(image) if isinstance(image, (list, tuple)) else [image]
+        if self.artifact_layout == 'panels' and len(panels) > 1:
+            paths = [self._write_screenshot(panel, suffix + "_" + str(k+1), metrics) for k, panel in enumerate(panels)]
+        else:
+            paths = [self._write_screenshot(panels, suffix, metrics)]
+        # panels shown separately take the same space as their concatenation
+        width = 50 / len(paths)
+        print("*HTML* " + "".join("<a href='" + path + "' target='_blank'><img src='" + path + "' style='width:{:g}%; height: auto;'/></a>".format(width) for path in paths))
+
+    def _write_screenshot(self, image, suffix, metrics=None):
         screenshot_name = str(str(uuid.uuid1()) + suffix + '.{}'.format(self.screenshot_format))
-        PABOTQUEUEINDEX = BuiltIn().get_variable_value('${PABOTQUEUEINDEX}', None)
+        PABOTQUEUEINDEX = self._get_variable_value('${PABOTQUEUEINDEX}', None)
         if PABOTQUEUEINDEX is not None:
             rel_screenshot_path = str(self.SCREENSHOT_DIRECTORY / '{}-{}'.format(PABOTQUEUEINDEX, screenshot_name))
         else:
             rel_screenshot_path = str(self.SCREENSHOT_DIRECTORY / screenshot_name)
         abs_screenshot_path = str(self.log_dir/self.SCREENSHOT_DIRECTORY/screenshot_name)
-        self._create_directory(abs_screenshot_path)
-        if self.screenshot_format == 'jpg':
-            cv2.imwrite(abs_screenshot_path, image, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
-        else:
-            cv2.imwrite(abs_screenshot_path, image)
-        print("*HTML* "+ "<a href='" + rel_screenshot_path + "' target='_blank'><img src='" + rel_screenshot_path + "' style='width:50%; height: auto;'/></a>")
+        params = self.SCREENSHOT_PARAMS[self.screenshot_format]
+        metrics = metrics or ComparisonMetrics()
 
-    def _create_directory(self, path):
-        target_dir = os.path.dirname(path)
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
+        def written(seconds, bytes_written):
+            metrics.add_stage('artifact_write', seconds)
+            metrics.count('bytes_written', bytes_written)
+        with metrics.stage('artifacts'):
+            if self.async_artifacts:
+                # The log entry refers to the final path, the file is written in the background
+                self.artifact_writer.submit(abs_screenshot_path, image, params, callback=written, max_dimension=self.artifact_max_dimension)
+            else:
+                tic = time.perf_counter()
+                bytes_written = write_image(abs_screenshot_path, image, params, max_dimension=self.artifact_max_dimension)
+                written(time.perf_counter() - tic, bytes_written)
+        return rel_screenshot_path
+
+    def flush_artifacts(self):
+        """Waits until all queued screenshots are written. Failed writes are logged as warnings."""
+        for error in self.artifact_writer.flush():
+            logger.warn(error)
     
     @property
     def log_dir(self):
+        logfile = self._get_variable_value("${LOG FILE}")
+        if logfile is None:
+            return os.getcwd()
+        if logfile == "NONE":
+            return self._get_variable_value("${OUTPUTDIR}")
+        return os.path.dirname(logfile)
+
+    def _get_variable_value(self, name, default=None):
+        if self.robot_variables is not None:
+            return self.robot_variables.get(name, default)
         try:
-            logfile = BuiltIn().get_variable_value("${LOG FILE}")
-            if logfile == "NONE":
-                return BuiltIn().get_variable_value("${OUTPUTDIR}")
-            return os.path.dirname(logfile)
+            return BuiltIn().get_variable_value(name, default)
         except RobotNotRunningError:
-            return os.getcwd()
+            return default
+
+    def _robot_variables(self):
+        """Returns the variables used by comparisons in other processes, i.e. batch workers and the comparison daemon."""
+        return {name: self._get_variable_value(name) for name in ('${REFERENCE_RUN}', '${PABOTQUEUEINDEX}', '${LOG FILE}', '${OUTPUTDIR}', '${SUITE NAME}', '${TEST NAME}')}
 
     def overlay_two_images(self, image, overlay, ignore_color=[255,255,255]):
         ignore_color = np.asarray(ignore_color)
@@ -264,46 +943,99 @@ class ImageCompare(object):
         out[mask] = image[mask] * 0.5 + overlay[mask] * 0.5
         return out
 
-    def check_for_differences(self, reference, candidate, i, detected_differences):
+    def check_for_differences(self, reference, candidate, i, detected_differences, engine='skimage', strategy='full', reference_entry=None, mask=None, method='ssim', threshold=None, pixel_tolerance=None, metrics=None, scale=1, color_sources=None):
+        """Compares page ``i``. ``color_sources`` are the reference and candidate the screenshots are decoded from
+        if the pages were decoded in grayscale or reduced by ``scale``."""
         images_are_equal = True
-        with futures.ThreadPoolExecutor(max_workers=2) as parallel_executor:
-            grayA_future = parallel_executor.submit(cv2.cvtColor, reference, cv2.COLOR_BGR2GRAY)
-            grayB_future = parallel_executor.submit(cv2.cvtColor, candidate, cv2.COLOR_BGR2GRAY)
-            grayA = grayA_future.result()
-            grayB = grayB_future.result()
+        metric = get_metric(method)
+        metrics = metrics or ComparisonMetrics()
+        if threshold is None:
+            threshold = self.threshold
+        if pixel_tolerance is None:
+            pixel_tolerance = self.pixel_tolerance
+
+        if scale > 1 and reference.shape[:2] != candidate.shape[:2] and all(abs(a - b) <= 1 for a, b in zip(reference.shape[:2], candidate.shape[:2])):
+            # reduced sizes are rounded differently, e.g. for JPEG and PNG files
+            reference, candidate, mask = self._crop_to_common_size(reference, candidate, mask)
+            # the cached grayscale image and moments have the uncropped size
+            reference_entry = None
 
         if reference.shape[0] != candidate.shape[0] or reference.shape[1] != candidate.shape[1]:
-            self.add_screenshot_to_log(reference, "_reference_page_" + str(i+1))
-            self.add_screenshot_to_log(candidate, "_candidate_page_" + str(i+1))
-            raise AssertionError(f'The compared images have different dimensions:\nreference:{reference.shape}\ncandidate:{candidate.shape}')
-        
-        # compute the Structural Similarity Index (SSIM) between the two
-        # images, ensuring that the difference image is returned
-        (score, diff) = metrics.structural_similarity(grayA, grayB, gaussian_weights=True, full=True)
-        score = abs(1-score)
+            shapes = reference.shape, candidate.shape
+            reference, candidate, _ = self._color_pages(reference, candidate, None, i, color_sources, metrics)
+            self.add_screenshot_to_log(reference, "_reference_page_" + str(i+1), metrics=metrics)
+            self.add_screenshot_to_log(candidate, "_candidate_page_" + str(i+1), metrics=metrics)
+            raise AssertionError(f'The compared images have different dimensions:\nreference:{shapes[0]}\ncandidate:{shapes[1]}')
+
+        metrics.count('pixels', reference.shape[0] * reference.shape[1])
+        momentsA = None
+        if not metric.gray or (reference.ndim == 2 and candidate.ndim == 2):
+            # nothing to convert, e.g. for pages decoded in grayscale
+            imageA, imageB = reference, candidate
+        else:
+            with metrics.stage('gray', page=i):
+                if reference_entry is not None:
+                    # the grayscale image of the reference is computed once per cache entry
+                    imageA = reference_entry.gray(i)
+                else:
+                    imageA = reference if reference.ndim == 2 else cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+                imageB = candidate if candidate.ndim == 2 else cv2.cvtColor(candidate, cv2.COLOR_BGR2GRAY)
+
+        with metrics.stage('metric', page=i):
+            if metric.gray and reference_entry is not None and method == 'ssim' and engine == 'opencv':
+                # the moments of the reference are computed once per cache entry
+                momentsA = reference_entry.gaussian_moments(i)
+            result = metric(imageA, imageB, mask=mask, engine=engine, strategy=strategy, momentsA=momentsA,
+                            pyramid_levels=self.pyramid_levels, pyramid_tile_size=self.pyramid_tile_size,
+                            pyramid_noise_floor=self.pyramid_noise_floor, pixel_tolerance=pixel_tolerance)
+        score = result.score
+        print('Page {}: {} score is {}'.format(i+1, method, score))
+
+        difference_maps = result.difference_maps
+        if color_sources is not None and (self.take_screenshots or score > threshold):
+            reference, candidate, mask = self._color_pages(reference, candidate, mask, i, color_sources, metrics)
+            reference, candidate, mask = self._crop_to_common_size(reference, candidate, mask)
+            if scale > 1:
+                size = (reference.shape[1], reference.shape[0])
+                difference_maps = lambda: tuple(cv2.resize(image, size, interpolation=cv2.INTER_NEAREST) for image in result.difference_maps())
+
+        if mask is not None and (self.take_screenshots or score > threshold):
+            reference = self.paint_mask(reference, mask)
+            candidate = self.paint_mask(candidate, mask)
         
         if self.take_screenshots:
             # Not necessary to take screenshots for every successful comparison
-            self.add_screenshot_to_log(np.concatenate((reference, candidate), axis=1), "_page_" + str(i+1) + "_compare_concat")
+            self.add_screenshot_to_log([reference, candidate], "_page_" + str(i+1) + "_compare_concat", metrics=metrics)
                
-        if (score > self.threshold):
+        if (score > threshold):
         
-            diff = (diff * 255).astype("uint8")
+            with metrics.stage('highlighting', page=i):
+                diff, thresh = difference_maps()
+                
+                reference_with_rect, candidate_with_rect , cnts= self.get_images_with_highlighted_differences(thresh, reference.copy(), candidate.copy(), extension=int(os.getenv('EXTENSION', 2)))
+                if self.artifact_policy == 'crops':
+                    crops = self.get_difference_crops(cnts, reference.shape)
+                else:
+                    blended_images = self.overlay_two_images(reference_with_rect, candidate_with_rect)
+                
+                    cv2.putText(reference_with_rect,self.REFERENCE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
+                    cv2.putText(candidate_with_rect,self.CANDIDATE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
 
-            thresh = cv2.threshold(diff, 0, 255,
-                cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-            
-            reference_with_rect, candidate_with_rect , cnts= self.get_images_with_highlighted_differences(thresh, reference.copy(), candidate.copy(), extension=int(os.getenv('EXTENSION', 2)))
-            blended_images = self.overlay_two_images(reference_with_rect, candidate_with_rect)
-            
-            cv2.putText(reference_with_rect,self.REFERENCE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
-            cv2.putText(candidate_with_rect,self.CANDIDATE_LABEL, self.BOTTOM_LEFT_CORNER_OF_TEXT, self.FONT, self.FONT_SCALE, self.FONT_COLOR, self.LINE_TYPE)
-            
-            self.add_screenshot_to_log(np.concatenate((reference_with_rect, candidate_with_rect), axis=1), "_page_" + str(i+1) + "_rectangles_concat")
-            self.add_screenshot_to_log(blended_images, "_page_" + str(i+1) + "_blended")
+            if self.artifact_policy == 'crops':
+                # Artifacts only cover the differences: reference, candidate and blended crop side by side
+                for k, (x0, y0, x1, y1) in enumerate(crops):
+                    reference_crop, candidate_crop = reference_with_rect[y0:y1, x0:x1], candidate_with_rect[y0:y1, x0:x1]
+                    panels = [reference_crop, candidate_crop, self.overlay_two_images(reference_crop, candidate_crop)]
+                    if self.show_diff:
+                        panels += [diff[y0:y1, x0:x1], thresh[y0:y1, x0:x1]]
+                    print('Page {}: difference {} at x={}, y={}, width={}, height={}'.format(i+1, k+1, x0, y0, x1 - x0, y1 - y0))
+                    self.add_screenshot_to_log(panels, "_page_" + str(i+1) + "_difference_" + str(k+1), metrics=metrics)
+            else:
+                self.add_screenshot_to_log([reference_with_rect, candidate_with_rect], "_page_" + str(i+1) + "_rectangles_concat", metrics=metrics)
+                self.add_screenshot_to_log(blended_images, "_page_" + str(i+1) + "_blended", metrics=metrics)
 
-            if self.show_diff:
-                self.add_screenshot_to_log(np.concatenate((diff, thresh), axis=1), "_page_" + str(i+1) + "_diff")
+                if self.show_diff:
+                    self.add_screenshot_to_log([diff, thresh], "_page_" + str(i+1) + "_diff", metrics=metrics)
 
             images_are_equal=False
             
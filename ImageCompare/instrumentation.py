@@ -0,0 +1,144 @@
+"""Per-stage timings and counters of image comparisons.
+
+Every ``Compare Images`` call records a ``ComparisonMetrics`` object with the
+time spent per stage (``decode``, ``masking``, ``gray``, ``metric``,
+``highlighting``, ``artifacts``), per page and in total, and counters such as
+bytes read and written, compared pixels and reference cache hits.
+
+Hooks registered with ``add_hook`` are called at the end of every stage, e.g.
+to forward the timings to an external profiler::
+
+    from ImageCompare import instrumentation
+    instrumentation.add_hook(lambda stage, seconds, page, metrics: print(stage, seconds))
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# artifact_write is the time spent encoding and writing screenshots in the background
+STAGES = ('decode', 'masking', 'gray', 'metric', 'highlighting', 'artifacts', 'artifact_write')
+
+_hooks = []
+# Metrics of the comparisons of this process, only collected if a report is configured (see ``add_record``)
+_records = []
+_records_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """Registers ``hook(stage, seconds, page, metrics)``, called at the end of every stage of every comparison."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+class ComparisonMetrics(object):
+
+    def __init__(self, reference_image=None, test_image=None, **context):
+        self.reference_image = reference_image
+        self.test_image = test_image
+        self.context = context
+        self.stages = []
+        self.counters = defaultdict(int)
+        self.result = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def stage(self, name, page=None):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - tic, page)
+
+    def add_stage(self, name, seconds, page=None):
+        with self._lock:
+            self.stages.append((name, page, seconds))
+        for hook in list(_hooks):
+            hook(name, seconds, page, self)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def finish(self, result):
+        self.result = result
+        self.total = time.perf_counter() - self._start
+
+    def stage_totals(self):
+        totals = defaultdict(float)
+        with self._lock:
+            for name, _, seconds in self.stages:
+                totals[name] += seconds
+        return dict(totals)
+
+    def as_dict(self):
+        pages = defaultdict(dict)
+        with self._lock:
+            for name, page, seconds in self.stages:
+                if page is not None:
+                    pages[page][name] = pages[page].get(name, 0.0) + seconds
+            counters = dict(self.counters)
+        return dict(self.context, reference=str(self.reference_image), candidate=str(self.test_image), result=self.result,
+                    total=self.total, stages=self.stage_totals(), pages={str(page + 1): stages for page, stages in sorted(pages.items())},
+                    counters=counters)
+
+    def summary(self):
+        stages = self.stage_totals()
+        return ', '.join('{} {:0.4f}s'.format(name, stages[name]) for name in STAGES if name in stages)
+
+
+class RecordedMetrics(object):
+    """Metrics dictionary of a comparison run in another process, e.g. the comparison daemon."""
+
+    def __init__(self, record):
+        self.record = record
+        self.result = record['result']
+        self.total = record['total']
+
+    def as_dict(self):
+        return dict(self.record)
+
+
+def add_record(record):
+    """Adds ``ComparisonMetrics`` or the metrics dictionary of a comparison run in another process to the report."""
+    with _records_lock:
+        _records.append(record)
+
+
+def records():
+    with _records_lock:
+        return list(_records)
+
+
+def clear_records():
+    with _records_lock:
+        del _records[:]
+
+
+def write_report(path):
+    """Writes the metrics of all comparisons of this process as JSON or, for a ``.csv`` path, as CSV."""
+    rows = [record.as_dict() if isinstance(record, ComparisonMetrics) else record for record in records()]
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temporary_file = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_file, 'w', newline='') as f:
+        if path.lower().endswith('.csv'):
+            counter_names = sorted({name for row in rows for name in row['counters']})
+            context_names = sorted({name for row in rows for name in row} - {'stages', 'pages', 'counters'})
+            writer = csv.writer(f)
+            writer.writerow(context_names + list(STAGES) + counter_names)
+            for row in rows:
+                writer.writerow([row.get(name) for name in context_names] + [row['stages'].get(name, 0.0) for name in STAGES]
+                                + [row['counters'].get(name, 0) for name in counter_names])
+        else:
+            json.dump(rows, f, indent=2)
+    os.replace(temporary_file, path)
@@ -0,0 +1,48 @@
+"""Lazily imported modules.
+
+``cv2`` and ``numpy`` take a noticeable part of the startup time of every
+pabot worker and ``libdoc`` run. Modules created with ``lazy_import`` are
+imported on first attribute access, so importing the library stays cheap
+until the first comparison.
+"""
+
+import importlib
+
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        # only called until the attribute is cached on this object
+        value = getattr(importlib.import_module(self._name), attribute)
+        setattr(self, attribute, value)
+        return value
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+class lazy_attribute(object):
+    """Class attribute computed on first access, e.g. from the constants of a lazily imported module::
+
+        FONT = lazy_attribute(lambda: cv2.FONT_HERSHEY_SIMPLEX)
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        value = self.function()
+        # later accesses get the value directly
+        setattr(owner, self.name, value)
+        return value
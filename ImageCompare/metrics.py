@@ -0,0 +1,143 @@
+"""Comparison metrics selectable with the ``method`` argument of ``Compare Images``.
+
+Every metric returns a ``MetricResult`` with a ``score`` (higher means more
+different) which is compared against the ``threshold``:
+
+- ``ssim``: ``1 - SSIM`` of the grayscale images.
+- ``pixel``: number of pixels for which any channel differs by more than ``pixel_tolerance``.
+- ``phash``: Hamming distance (0-64) of the perceptual hashes of the grayscale images.
+- ``histogram``: ``1 - correlation`` (0-2) of the grayscale histograms.
+
+The difference maps used to highlight differences are only computed on demand.
+Metrics are registered with ``register_metric``.
+"""
+
+from .lazy import lazy_import
+from .ssim import structural_similarity, structural_similarity_pyramid, masked_score
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+METRICS = {}
+
+
+class Metric(object):
+
+    def __init__(self, name, function, gray=True):
+        self.name = name
+        self.function = function
+        # True if the metric compares grayscale images, False if it compares the decoded images
+        self.gray = gray
+
+    def __call__(self, reference, candidate, mask=None, **options):
+        return self.function(reference, candidate, mask=mask, **options)
+
+
+class MetricResult(object):
+
+    def __init__(self, score, difference_maps):
+        self.score = score
+        self._difference_maps = difference_maps
+
+    def difference_maps(self):
+        """Returns the uint8 ``(diff, thresh)`` maps: ``diff`` is 255 for equal pixels, ``thresh`` is 255 for differing pixels."""
+        return self._difference_maps()
+
+
+def register_metric(name, gray=True):
+    """Decorator registering ``function(reference, candidate, mask=None, **options)`` as metric ``name``."""
+    def decorator(function):
+        METRICS[name] = Metric(name, function, gray=gray)
+        return function
+    return decorator
+
+
+def get_metric(method):
+    if method not in METRICS:
+        raise ValueError('Unknown comparison method "{}". Supported methods: {}'.format(method, ', '.join(METRICS)))
+    return METRICS[method]
+
+
+def _absolute_difference(reference, candidate, mask=None):
+    absdiff = cv2.absdiff(reference, candidate)
+    if absdiff.ndim == 3:
+        absdiff = absdiff.max(axis=2)
+    if mask is not None:
+        absdiff[mask == 0] = 0
+    return absdiff
+
+
+def _tolerance_maps(reference, candidate, mask=None, pixel_tolerance=0):
+    absdiff = _absolute_difference(reference, candidate, mask)
+    thresh = cv2.threshold(absdiff, pixel_tolerance, 255, cv2.THRESH_BINARY)[1]
+    return cv2.bitwise_not(absdiff), thresh
+
+
+@register_metric('ssim')
+def compare_ssim(grayA, grayB, mask=None, engine='skimage', strategy='full', momentsA=None,
+                 pyramid_levels=2, pyramid_tile_size=256, pyramid_noise_floor=0, **options):
+    # compute the Structural Similarity Index (SSIM) between the two
+    # images, ensuring that the difference image is returned
+    if strategy == 'pyramid':
+        (score, diff) = structural_similarity_pyramid(grayA, grayB, engine=engine, levels=pyramid_levels, tile_size=pyramid_tile_size, noise_floor=pyramid_noise_floor, momentsA=momentsA)
+    else:
+        (score, diff) = structural_similarity(grayA, grayB, engine=engine, momentsA=momentsA)
+    if mask is not None:
+        # masked pixels neither count for the score nor for the difference threshold
+        score = masked_score(diff, mask)
+
+    def difference_maps():
+        if mask is not None:
+            diff[mask == 0] = 1
+        diff_image = (diff * 255).astype("uint8")
+        thresh = cv2.threshold(diff_image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+        return diff_image, thresh
+
+    return MetricResult(abs(1 - score), difference_maps)
+
+
+@register_metric('pixel', gray=False)
+def compare_pixels(reference, candidate, mask=None, pixel_tolerance=0, **options):
+    diff, thresh = _tolerance_maps(reference, candidate, mask, pixel_tolerance)
+    return MetricResult(cv2.countNonZero(thresh), lambda: (diff, thresh))
+
+
+@register_metric('phash')
+def compare_phash(grayA, grayB, mask=None, pixel_tolerance=0, **options):
+    if mask is not None:
+        # masked pixels of the candidate take the values of the reference
+        grayB = grayB.copy()
+        grayB[mask == 0] = grayA[mask == 0]
+    distance = hamming_distance(phash(grayA), phash(grayB))
+    return MetricResult(distance, lambda: _tolerance_maps(grayA, grayB, mask, pixel_tolerance))
+
+
+@register_metric('histogram')
+def compare_histograms(grayA, grayB, mask=None, pixel_tolerance=0, **options):
+    histA = cv2.calcHist([grayA], [0], mask, [256], [0, 256])
+    histB = cv2.calcHist([grayB], [0], mask, [256], [0, 256])
+    correlation = cv2.compareHist(histA, histB, cv2.HISTCMP_CORREL)
+    return MetricResult(1 - correlation, lambda: _tolerance_maps(grayA, grayB, mask, pixel_tolerance))
+
+
+def phash(gray, hash_size=8):
+    """Perceptual hash: sign of the low frequency DCT coefficients relative to their median, as integer."""
+    resized = cv2.resize(gray, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(np.float32(resized))[:hash_size, :hash_size].flatten()
+    # the DC coefficient only reflects the average brightness
+    median = np.median(low_frequencies[1:])
+    return _bits_to_int(low_frequencies > median)
+
+
+def dhash(gray, hash_size=8):
+    """Difference hash: sign of the horizontal gradients of the downscaled image, as integer."""
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _bits_to_int((resized[:, 1:] > resized[:, :-1]).flatten())
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hashA, hashB):
+    return bin(hashA ^ hashB).count('1')
@@ -0,0 +1,92 @@
+"""Page by page decoding of multi-page documents.
+
+A document is an image file, a multi-page TIFF file or a directory of page
+images, sorted in natural order (``page2.png`` before ``page10.png``).
+``iter_pages`` decodes one page at a time, so the memory needed to compare two
+documents depends on the number of pages in flight, not on their length.
+"""
+
+import os
+import re
+
+from . import sources
+from .batch import IMAGE_EXTENSIONS
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+# Only these formats are checked for multiple pages, for all others cv2.imcount is skipped
+MULTI_PAGE_EXTENSIONS = ('.tif', '.tiff')
+
+
+def _natural_key(filename):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', filename)]
+
+
+def page_files(directory):
+    """Returns the page images of ``directory`` in natural order."""
+    filenames = [filename for filename in os.listdir(directory)
+                 if filename.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(directory, filename))]
+    return [os.path.join(directory, filename) for filename in sorted(filenames, key=_natural_key)]
+
+
+def page_count(image):
+    if os.path.isdir(image):
+        return len(page_files(image))
+    if image.lower().endswith(MULTI_PAGE_EXTENSIONS):
+        return max(cv2.imcount(image), 1)
+    return 1
+
+
+def is_multi_page(image):
+    return os.path.isdir(image) or page_count(image) > 1
+
+
+def document_size(image):
+    """Returns the size of the document on disk in bytes."""
+    if os.path.isdir(image):
+        return sum(os.path.getsize(path) for path in page_files(image))
+    return os.path.getsize(image)
+
+
+def decode(path, flags=None):
+    image = cv2.imread(path, cv2.IMREAD_COLOR if flags is None else flags)
+    if image is None:
+        raise AssertionError("No OpenCV Image could be created for file {} . Maybe the file is corrupt?".format(path))
+    return image
+
+
+def iter_pages(image, flags=None):
+    """Yields the decoded pages of the document ``image`` one by one."""
+    flags = cv2.IMREAD_COLOR if flags is None else flags
+    if os.path.isdir(image):
+        for path in page_files(image):
+            yield decode(path, flags)
+        return
+    count = page_count(image)
+    if count == 1:
+        yield decode(image, flags)
+        return
+    for page in range(count):
+        success, images = cv2.imreadmulti(image, page, 1, flags=flags)
+        if not success or not images:
+            raise AssertionError('Page {} of {} could not be decoded. Maybe the file is corrupt?'.format(page + 1, image))
+        yield images[0]
+
+
+def decode_page(image, page, flags=None):
+    """Decodes only page ``page`` (starting at 0) of the document or image data ``image``.
+
+    Used to decode a page again in color for the screenshots if it was compared in grayscale.
+    """
+    if sources.is_image_data(image):
+        return sources.decode(image, flags)
+    flags = cv2.IMREAD_COLOR if flags is None else flags
+    if os.path.isdir(image):
+        return decode(page_files(image)[page], flags)
+    if page_count(image) == 1:
+        return decode(image, flags)
+    success, images = cv2.imreadmulti(image, page, 1, flags=flags)
+    if not success or not images:
+        raise AssertionError('Page {} of {} could not be decoded. Maybe the file is corrupt?'.format(page + 1, image))
+    return images[0]
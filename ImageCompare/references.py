@@ -0,0 +1,108 @@
+"""Saving new references in reference runs.
+
+References are written to a temporary file in the target directory and
+renamed, so parallel pabot processes never see torn files. A reference whose
+content did not change is not rewritten at all.
+
+With a blob directory, references are stored content-addressed: each distinct
+content is saved once as ``<blobs>/<sha256[:2]>/<sha256><extension>`` and
+the reference file is a hard link to it. Identical baselines, e.g. the same
+empty state in all locales, take space only once. If hard links are not
+possible, e.g. across file systems, the reference is copied instead.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+
+from . import sources
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+
+def content_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _temporary_path(path):
+    return '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def _write_atomically(path, data=None, source=None):
+    """Writes ``data`` or a copy of the file ``source`` to ``path`` via a temporary file in the same directory."""
+    temporary_file = _temporary_path(path)
+    try:
+        if source is not None:
+            shutil.copyfile(source, temporary_file)
+        else:
+            with open(temporary_file, 'wb') as f:
+                f.write(data)
+        os.replace(temporary_file, path)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+def _link_atomically(blob, path):
+    temporary_file = _temporary_path(path)
+    try:
+        os.link(blob, temporary_file)
+    except OSError:
+        _write_atomically(path, source=blob)
+        return
+    os.replace(temporary_file, path)
+
+
+def _encoded(candidate, reference_image):
+    """Returns the candidate as encoded bytes, or None if it is a file which can be copied as it is."""
+    if not sources.is_image_data(candidate):
+        return None
+    data = sources.encoded_bytes(candidate)
+    if data is not None:
+        return data
+    # numpy arrays are encoded in the format of the reference file
+    success, encoded = cv2.imencode(os.path.splitext(reference_image)[1] or '.png', candidate)
+    if not success:
+        raise IOError('The image could not be encoded for {}'.format(reference_image))
+    return encoded.tobytes()
+
+
+def save_reference(candidate, reference_image, blob_directory=None):
+    """Saves ``candidate`` (a file path or image data) as ``reference_image``.
+
+    Returns False if ``reference_image`` already had the same content and was not written.
+    """
+    data = _encoded(candidate, reference_image)
+    if data is not None:
+        new_hash, new_size = hashlib.sha256(data).hexdigest(), len(data)
+    else:
+        new_hash, new_size = content_hash(candidate), os.path.getsize(candidate)
+    if os.path.isfile(reference_image) and os.path.getsize(reference_image) == new_size and content_hash(reference_image) == new_hash:
+        return False
+    os.makedirs(os.path.dirname(os.path.abspath(reference_image)), exist_ok=True)
+    if blob_directory is None:
+        _write_atomically(reference_image, data=data, source=candidate if data is None else None)
+        return True
+    blob = os.path.join(blob_directory, new_hash[:2], new_hash + os.path.splitext(reference_image)[1].lower())
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        _write_atomically(blob, data=data, source=candidate if data is None else None)
+    _link_atomically(blob, reference_image)
+    return True
+
+
+def save_reference_directory(candidate_directory, reference_directory, blob_directory=None):
+    """Saves all files of ``candidate_directory`` to ``reference_directory``. Returns the number of written files."""
+    written = 0
+    for root, _, files in os.walk(candidate_directory):
+        for filename in files:
+            candidate = os.path.join(root, filename)
+            reference = os.path.join(reference_directory, os.path.relpath(candidate, candidate_directory))
+            written += save_reference(candidate, reference, blob_directory=blob_directory)
+    return written
@@ -0,0 +1,155 @@
+"""Images passed as data instead of file paths.
+
+Besides file paths, ``Compare Images`` and ``CompareImage`` accept decoded
+images (numpy arrays in BGR or grayscale), encoded image files as ``bytes``
+and base64 strings, optionally as ``data:image/...;base64,`` URI, as returned
+by screenshot keywords of Browser and SeleniumLibrary. They are decoded with
+``cv2.imdecode`` without temporary files.
+
+Strings without ``data:`` prefix are only treated as base64 data if the decoded
+bytes start with the signature of a known image or document format, all other
+strings are paths.
+
+``decode_flags`` returns the ``cv2.IMREAD_*`` flags which decode images in
+grayscale and/or reduced by 2, 4 or 8 directly, e.g. JPEG files are then only
+partially decompressed. Numpy arrays are converted and resized accordingly.
+"""
+
+import base64
+import binascii
+import os
+
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# PNG, JPEG, GIF, BMP, TIFF, WebP (RIFF container) and PDF
+SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*', b'RIFF', b'%PDF')
+# Characters of the base64 prefix decoded to check the signature, 12 bytes
+SIGNATURE_LENGTH = 16
+# Comparison scales supported by cv2.IMREAD_REDUCED_*
+SCALES = (1, 2, 4, 8)
+
+
+def _has_image_signature(payload):
+    try:
+        header = base64.b64decode(payload[:SIGNATURE_LENGTH], validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    if header.startswith(b'RIFF'):
+        return header[8:12] == b'WEBP'
+    return header.startswith(SIGNATURES)
+
+
+def _base64_payload(image):
+    if image.startswith('data:'):
+        return image.partition(',')[2]
+    if _has_image_signature(image):
+        return image
+    return None
+
+
+def is_image_data(image):
+    """Returns True if ``image`` is a numpy array, encoded bytes or a base64 string instead of a path."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return True
+    if isinstance(image, str):
+        return _base64_payload(image) is not None
+    return type(image).__module__ == 'numpy' and hasattr(image, 'shape')
+
+
+def encoded_bytes(image):
+    """Returns the encoded image file of ``bytes`` or a base64 string, None for numpy arrays."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if isinstance(image, str):
+        try:
+            return base64.b64decode(_base64_payload(image))
+        except (binascii.Error, ValueError) as error:
+            raise AssertionError('The image is neither an existing file nor valid base64 data: {}'.format(error))
+    return None
+
+
+def decode_base64(image):
+    """Returns base64 strings decoded to ``bytes`` and all other images as they are.
+
+    Called once per comparison, so that a base64 string is only classified and decoded once.
+    """
+    if isinstance(image, str) and _base64_payload(image) is not None:
+        return encoded_bytes(image)
+    return image
+
+
+def decode_flags(grayscale=False, scale=1):
+    """Returns the ``cv2.IMREAD_*`` flags decoding in grayscale or color, reduced by ``scale`` (1, 2, 4 or 8)."""
+    scale = int(scale)
+    if scale not in SCALES:
+        raise ValueError('The comparison scale must be one of {}, got {}'.format(', '.join(str(scale) for scale in SCALES), scale))
+    if scale == 1:
+        return cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    return getattr(cv2, 'IMREAD_REDUCED_{}_{}'.format('GRAYSCALE' if grayscale else 'COLOR', scale))
+
+
+def decode_mode(flags):
+    """Returns ``(grayscale, scale)`` of ``flags`` returned by ``decode_flags``, ``(False, 1)`` for other flags."""
+    for grayscale in (False, True):
+        for scale in SCALES:
+            if flags == decode_flags(grayscale, scale):
+                return grayscale, scale
+    return False, 1
+
+
+def decode(image, flags=None):
+    """Returns ``image`` as BGR (or, with grayscale ``flags``, gray) uint8 array."""
+    flags = cv2.IMREAD_COLOR if flags is None else flags
+    data = encoded_bytes(image)
+    if data is not None:
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if decoded is None:
+            raise AssertionError('No OpenCV Image could be created from {}. Maybe the data is corrupt?'.format(describe(image)))
+        return decoded
+    if image.dtype != np.uint8:
+        raise AssertionError('Only 8 bit images can be compared, got an array of {}'.format(image.dtype))
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    if image.ndim not in (2, 3) or image.ndim == 3 and image.shape[2] != 3:
+        raise AssertionError('Unsupported image array of shape {}'.format(image.shape))
+    grayscale, scale = decode_mode(flags)
+    # the caller's array is never modified or made read-only by the comparison
+    if image.ndim == 3 and grayscale:
+        decoded = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif image.ndim == 2 and not grayscale:
+        decoded = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    else:
+        decoded = image.copy()
+    if scale > 1:
+        # same size as cv2.IMREAD_REDUCED_* of a PNG file
+        decoded = cv2.resize(decoded, (decoded.shape[1] // scale, decoded.shape[0] // scale), interpolation=cv2.INTER_LINEAR_EXACT)
+    return decoded
+
+
+def describe(image):
+    """Returns a short description of ``image`` for logs and reports, the path for files."""
+    if not is_image_data(image):
+        return str(image)
+    if isinstance(image, str):
+        return '<base64 image, {} characters>'.format(len(image))
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return '<encoded image, {} bytes>'.format(len(image))
+    return '<image array {}>'.format('x'.join(str(dimension) for dimension in image.shape))
+
+
+def size(image):
+    """Returns the number of bytes read to decode ``image``."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return memoryview(image).nbytes
+    if isinstance(image, str):
+        payload = _base64_payload(image)
+        if payload is None:
+            return os.path.getsize(image)
+        # computed from the length, the payload is not decoded again
+        payload = payload.rstrip()
+        return len(payload) * 3 // 4 - payload[-2:].count('=')
+    return 0
+
@@ -0,0 +1,212 @@
+"""Structural Similarity Index (SSIM) engines used by ``check_for_differences``.
+
+Two engines compute the same Gaussian-windowed SSIM as
+``skimage.metrics.structural_similarity(..., gaussian_weights=True, full=True)``:
+
+- ``skimage``: the reference implementation, computed in float64.
+- ``opencv``: computed in float32 with ``cv2.GaussianBlur`` and ``cv2.multiply``.
+  OpenCV releases the GIL for all of these calls and temporaries are reused
+  in place, so it is considerably faster and lighter on memory for large pages.
+
+For 8-bit grayscale images the score of the ``opencv`` engine differs from the
+``skimage`` score by less than ``OPENCV_TOLERANCE``.
+"""
+
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+ENGINES = ('skimage', 'opencv')
+STRATEGIES = ('full', 'pyramid')
+
+# Maximum absolute deviation of the opencv score from the skimage score
+OPENCV_TOLERANCE = 1e-4
+
+# Parameters matching skimage with gaussian_weights=True
+SIGMA = 1.5
+WIN_SIZE = 11
+K1 = 0.01
+K2 = 0.03
+DATA_RANGE = 255
+COV_NORM = WIN_SIZE ** 2 / (WIN_SIZE ** 2 - 1)
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError('Unknown SSIM engine "{}". Supported engines: {}'.format(engine, ', '.join(ENGINES)))
+    return engine
+
+
+def check_strategy(strategy):
+    if strategy not in STRATEGIES:
+        raise ValueError('Unknown comparison strategy "{}". Supported strategies: {}'.format(strategy, ', '.join(STRATEGIES)))
+    return strategy
+
+
+def structural_similarity(grayA, grayB, engine='skimage', momentsA=None):
+    """Returns the mean SSIM score and the full SSIM map of two grayscale images.
+
+    ``momentsA`` may contain the precomputed ``gaussian_moments(grayA)``, it is only used by the ``opencv`` engine.
+    """
+    check_engine(engine)
+    if engine == 'opencv':
+        return structural_similarity_opencv(grayA, grayB, momentsA=momentsA)
+    from skimage import metrics
+    return metrics.structural_similarity(grayA, grayB, gaussian_weights=True, full=True)
+
+
+def _blur(src, dst=None):
+    return cv2.GaussianBlur(src, (WIN_SIZE, WIN_SIZE), SIGMA, dst=dst, sigmaY=SIGMA, borderType=cv2.BORDER_REFLECT)
+
+
+def gaussian_moments(gray):
+    """Returns the Gaussian weighted mean and variance (mu, sigma²) of a grayscale image as float32 arrays."""
+    x = np.asarray(gray, dtype=np.float32)
+    mu = _blur(x)
+    sigma_sq = _blur(cv2.multiply(x, x))
+    # sigma² = cov_norm * (E[x²] - mu²)
+    cv2.subtract(sigma_sq, cv2.multiply(mu, mu), dst=sigma_sq)
+    cv2.multiply(sigma_sq, COV_NORM, dst=sigma_sq)
+    return mu, sigma_sq
+
+
+def structural_similarity_opencv(grayA, grayB, momentsA=None):
+    """float32 SSIM computed with OpenCV.
+
+    ``momentsA`` may contain the precomputed result of ``gaussian_moments(grayA)``.
+    """
+    if grayA.shape != grayB.shape:
+        raise ValueError('Input images must have the same dimensions.')
+    if min(grayA.shape[:2]) < WIN_SIZE:
+        raise ValueError('Images must be at least {0}x{0} pixels for SSIM.'.format(WIN_SIZE))
+    C1 = (K1 * DATA_RANGE) ** 2
+    C2 = (K2 * DATA_RANGE) ** 2
+
+    if momentsA is None:
+        momentsA = gaussian_moments(grayA)
+    mu_x, var_x = momentsA
+    x = np.asarray(grayA, dtype=np.float32)
+    y = np.asarray(grayB, dtype=np.float32)
+
+    mu_y = _blur(y)
+    # tmp holds E[y²], then sigma_y²
+    tmp = cv2.multiply(y, y)
+    _blur(tmp, dst=tmp)
+    mu_y_sq = cv2.multiply(mu_y, mu_y)
+    cv2.subtract(tmp, mu_y_sq, dst=tmp)
+    # B2 = sigma_x² + sigma_y² + C2
+    b2 = cv2.scaleAdd(tmp, COV_NORM, var_x)
+    cv2.add(b2, C2, dst=b2)
+
+    # tmp holds E[xy], then sigma_xy, then A2 = 2 * sigma_xy + C2
+    cv2.multiply(x, y, dst=tmp)
+    _blur(tmp, dst=tmp)
+    mu_xy = cv2.multiply(mu_x, mu_y)
+    cv2.subtract(tmp, mu_xy, dst=tmp)
+    cv2.multiply(tmp, 2 * COV_NORM, dst=tmp)
+    cv2.add(tmp, C2, dst=tmp)
+
+    # A1 = 2 * mu_x * mu_y + C1, stored in mu_xy
+    cv2.multiply(mu_xy, 2, dst=mu_xy)
+    cv2.add(mu_xy, C1, dst=mu_xy)
+    # B1 = mu_x² + mu_y² + C1, stored in mu_y_sq
+    cv2.add(mu_y_sq, cv2.multiply(mu_x, mu_x, dst=mu_y), dst=mu_y_sq)
+    cv2.add(mu_y_sq, C1, dst=mu_y_sq)
+
+    # S = (A1 * A2) / (B1 * B2)
+    cv2.multiply(mu_xy, tmp, dst=mu_xy)
+    cv2.multiply(mu_y_sq, b2, dst=mu_y_sq)
+    S = cv2.divide(mu_xy, mu_y_sq, dst=mu_xy)
+
+    # to avoid edge effects the filter radius strip around edges is ignored
+    pad = (WIN_SIZE - 1) // 2
+    score = float(cv2.mean(S[pad:S.shape[0] - pad, pad:S.shape[1] - pad])[0])
+    return score, S
+
+
+def masked_score(S, mask):
+    """Mean SSIM of the pixels which are not excluded by ``mask`` (0 = excluded), ignoring the filter radius at the edges."""
+    pad = (WIN_SIZE - 1) // 2
+    cropped_mask = mask[pad:mask.shape[0] - pad, pad:mask.shape[1] - pad]
+    if cv2.countNonZero(cropped_mask) == 0:
+        return 1.0
+    return float(cv2.mean(S[pad:S.shape[0] - pad, pad:S.shape[1] - pad], mask=cropped_mask)[0])
+
+
+def _max_pool(image):
+    """Halves the size of a binary image, a pixel is set if any of the 2x2 pixels it covers is set."""
+    height, width = image.shape[:2]
+    padded = cv2.copyMakeBorder(image, 0, height % 2, 0, width % 2, cv2.BORDER_CONSTANT, value=0)
+    return cv2.max(cv2.max(padded[0::2, 0::2], padded[1::2, 0::2]), cv2.max(padded[0::2, 1::2], padded[1::2, 1::2]))
+
+
+def candidate_regions(grayA, grayB, levels=2, tile_size=256, noise_floor=0):
+    """Returns the full resolution rectangles ``(x, y, w, h)`` which may contain differences.
+
+    The pixels whose absolute difference is above ``noise_floor`` are found at
+    full resolution and max-pooled ``levels`` times, so no difference is lost
+    when the tiles are checked on the smaller map. A tile of ``tile_size``
+    pixels is a candidate if it contains a changed pixel or one within reach
+    of the SSIM window. Adjacent candidate tiles of a row are merged into one rectangle.
+    """
+    changed = cv2.threshold(cv2.absdiff(grayA, grayB), noise_floor, 255, cv2.THRESH_BINARY)[1]
+    if cv2.countNonZero(changed) == 0:
+        return []
+    for _ in range(levels):
+        changed = _max_pool(changed)
+    # differences influence the SSIM of all pixels within the window radius
+    reach = (WIN_SIZE // 2 >> levels) + 1
+    changed = cv2.dilate(changed, np.ones((2 * reach + 1, 2 * reach + 1), np.uint8))
+
+    scale = 2 ** levels
+    height, width = grayA.shape[:2]
+    regions = []
+    for y in range(0, height, tile_size):
+        run_start = None
+        for x in range(0, width + tile_size, tile_size):
+            is_candidate = x < width and cv2.countNonZero(changed[y // scale:-(-(y + tile_size) // scale), x // scale:-(-(x + tile_size) // scale)]) > 0
+            if is_candidate and run_start is None:
+                run_start = x
+            elif not is_candidate and run_start is not None:
+                regions.append((run_start, y, min(x, width) - run_start, min(tile_size, height - y)))
+                run_start = None
+    return regions
+
+
+def structural_similarity_pyramid(grayA, grayB, engine='skimage', levels=2, tile_size=256, noise_floor=0, momentsA=None):
+    """Coarse-to-fine SSIM: full resolution SSIM is only computed for candidate regions.
+
+    Returns the same ``(score, S)`` as ``structural_similarity``. Pixels outside of
+    candidate regions differ by at most ``noise_floor`` and get a SSIM of 1.
+    The SSIM is only computed at full resolution for the changed area of the images.
+    """
+    check_engine(engine)
+    if grayA.shape != grayB.shape:
+        raise ValueError('Input images must have the same dimensions.')
+    height, width = grayA.shape[:2]
+    S = np.ones(grayA.shape[:2], dtype=np.float32 if engine == 'opencv' else np.float64)
+    pad = (WIN_SIZE - 1) // 2
+    cropped_pixels = (height - 2 * pad) * (width - 2 * pad)
+    # start with a score of 1 for every pixel and correct it for each candidate region
+    score_sum = float(cropped_pixels)
+    for (x, y, w, h) in candidate_regions(grayA, grayB, levels=levels, tile_size=tile_size, noise_floor=noise_floor):
+        # the halo makes the SSIM inside the region identical to a full image computation
+        y_start, y_end = _expand(y, y + h, pad, height)
+        x_start, x_end = _expand(x, x + w, pad, width)
+        region_moments = None
+        if momentsA is not None:
+            region_moments = tuple(moment[y_start:y_end, x_start:x_end] for moment in momentsA)
+        region_S = structural_similarity(grayA[y_start:y_end, x_start:x_end], grayB[y_start:y_end, x_start:x_end], engine=engine, momentsA=region_moments)[1]
+        S[y:y + h, x:x + w] = region_S[y - y_start:y - y_start + h, x - x_start:x - x_start + w]
+        cropped = S[max(y, pad):min(y + h, height - pad), max(x, pad):min(x + w, width - pad)]
+        score_sum += float(cropped.sum(dtype=np.float64)) - cropped.size
+    return score_sum / cropped_pixels, S
+
+
+def _expand(start, end, halo, limit):
+    start, end = max(0, start - halo), min(limit, end + halo)
+    if end - start < WIN_SIZE:
+        start = max(0, end - WIN_SIZE)
+        end = min(limit, start + WIN_SIZE)
+    return start, end
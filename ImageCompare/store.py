@@ -0,0 +1,139 @@
+"""On-disk store of decoded reference images as memory-mapped ``.npy`` files.
+
+Decoding large PNG/JPEG references takes a large part of every comparison.
+The store keeps the decoded pages of each reference, and optionally their
+grayscale images, as ``.npy`` files. They are opened with
+``np.load(mmap_mode='r')``, so all processes of a pabot run share the same
+pages of the OS page cache instead of decoding and holding their own copies.
+
+Every reference has a small JSON manifest with the SHA-1 hash, modification
+time and size of the source file. An entry is only used while the hash of the
+source file matches; the hash is only recomputed if modification time or size
+changed. Files are written to temporary files and renamed, so concurrent
+processes never read partially written files.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from .lazy import lazy_import
+
+np = lazy_import('numpy')
+cv2 = lazy_import('cv2')
+
+STORE_VERSION = 1
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _temporary_path(path):
+    # unique per thread, threads of one process store the same reference concurrently
+    return '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def _write_atomically(path, write):
+    temporary_file = _temporary_path(path)
+    try:
+        with open(temporary_file, 'wb') as f:
+            write(f)
+        os.replace(temporary_file, path)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+class ReferenceStore(object):
+
+    def __init__(self, directory, gray=False):
+        self.directory = os.path.abspath(directory)
+        # Also store the grayscale images, used by the ssim, phash and histogram methods
+        self.gray = gray
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _key(self, image):
+        return hashlib.sha1(os.path.abspath(image).encode()).hexdigest()
+
+    def _manifest_path(self, image):
+        return os.path.join(self.directory, self._key(image) + '.json')
+
+    def _read_manifest(self, image):
+        try:
+            with open(self._manifest_path(image)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if manifest.get('version') != STORE_VERSION or manifest.get('source') != os.path.abspath(image):
+            return None
+        return manifest
+
+    def _write_manifest(self, image, manifest):
+        _write_atomically(self._manifest_path(image), lambda f: f.write(json.dumps(manifest).encode()))
+
+    def load(self, image):
+        """Returns the memory-mapped ``(pages, gray_pages)`` of the reference file ``image``, or None if not stored or outdated.
+
+        ``gray_pages`` contains None for pages without stored grayscale image.
+        """
+        manifest = self._read_manifest(image)
+        if manifest is None:
+            return None
+        stat = os.stat(image)
+        if (manifest['mtime'], manifest['size']) != (stat.st_mtime_ns, stat.st_size):
+            if file_hash(image) != manifest['hash']:
+                return None
+            # touched, but unchanged
+            manifest['mtime'], manifest['size'] = stat.st_mtime_ns, stat.st_size
+            self._write_manifest(image, manifest)
+        try:
+            pages = [np.load(os.path.join(self.directory, name), mmap_mode='r') for name in manifest['pages']]
+            gray_pages = [np.load(os.path.join(self.directory, name), mmap_mode='r') if name else None for name in manifest['gray']]
+        except (IOError, ValueError):
+            return None
+        return pages, gray_pages
+
+    def add(self, image, pages):
+        """Stores the decoded ``pages`` of the reference file ``image``, replacing an outdated entry."""
+        stat = os.stat(image)
+        content_hash = file_hash(image)
+        previous = self._read_manifest(image)
+        prefix = '{}-{}'.format(self._key(image), content_hash[:16])
+        manifest = {'version': STORE_VERSION, 'source': os.path.abspath(image), 'hash': content_hash,
+                    'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'pages': [], 'gray': []}
+        for page, array in enumerate(pages):
+            manifest['pages'].append(self._save_array('{}-{}.npy'.format(prefix, page), array))
+            gray_name = None
+            if self.gray:
+                gray_name = self._save_array('{}-{}-gray.npy'.format(prefix, page), cv2.cvtColor(array, cv2.COLOR_BGR2GRAY))
+            manifest['gray'].append(gray_name)
+        self._write_manifest(image, manifest)
+        if previous is not None:
+            self._remove_arrays(previous, keep=manifest)
+        return manifest
+
+    def refresh(self, image):
+        """Decodes the reference file ``image`` and stores it, e.g. after it was replaced in a reference run."""
+        from .pages import iter_pages
+        return self.add(image, list(iter_pages(image)))
+
+    def _save_array(self, name, array):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            _write_atomically(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+        return name
+
+    def _remove_arrays(self, manifest, keep):
+        names = set(manifest['pages']) | {name for name in manifest['gray'] if name}
+        names -= set(keep['pages']) | {name for name in keep['gray'] if name}
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
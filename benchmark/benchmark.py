@@ -0,0 +1,180 @@
+"""Benchmark of the image comparison pipeline.
+
+Generates synthetic screenshot-like images offline and times every stage of
+the pipeline separately:
+
+- ``load``: ``CompareImage`` creation, i.e. ``load_image_into_array``
+- ``mask_compile``: ``CompareImage.get_comparison_mask``
+- ``grayscale``: ``cv2.cvtColor`` of reference and candidate
+- ``ssim_<engine>`` and ``ssim_<engine>_pyramid``: the SSIM metric
+- ``pixel``: the pixel metric
+- ``contours``: ``ImageCompare.get_images_with_highlighted_differences``
+- ``screenshot``: ``ImageCompare.add_screenshot_to_log`` (synchronous write)
+- ``compare_images``: the whole ``Compare Images`` keyword
+
+Results are written as JSON, e.g.::
+
+    python benchmark/benchmark.py --sizes 1 4 16 50 100 --pages 1 3 --output benchmark.json
+
+or ``invoke benchmark --sizes "1 4 16 50 100"``.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageCompare import ImageCompare  # noqa: E402
+import ImageCompare.CompareImage as compare_image_module  # noqa: E402
+from ImageCompare.CompareImage import CompareImage  # noqa: E402
+from ImageCompare.metrics import get_metric  # noqa: E402
+
+MASK = json.dumps([
+    {"page": "all", "name": "Header", "type": "area", "location": "top", "percent": 5},
+    {"page": "all", "name": "Date", "type": "coordinates", "x": 40, "y": 200, "width": 300, "height": 40, "unit": "px"},
+])
+
+
+def synthetic_image(megapixels, seed):
+    """Screenshot-like image: flat background, panels, lines of text and a noisy photo area."""
+    width = int((megapixels * 1e6 * 16 / 9) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 245, dtype=np.uint8)
+    for _ in range(max(4, int(megapixels * 8))):
+        x, y = int(rng.integers(0, width - 50)), int(rng.integers(0, height - 50))
+        w, h = int(rng.integers(50, max(51, width // 4))), int(rng.integers(30, max(31, height // 6)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(image, (x, y), (x + w, y + h), color, -1)
+        cv2.putText(image, 'Lorem ipsum {}'.format(int(rng.integers(0, 1000))), (x + 5, y + 25),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+    photo = image[height // 2:height // 2 + height // 4, width // 2:width // 2 + width // 4]
+    photo[:] = cv2.GaussianBlur(rng.integers(0, 255, photo.shape, dtype=np.uint8), (7, 7), 3)
+    return image
+
+
+def slightly_different(image):
+    """Copy of ``image`` with one changed widget."""
+    changed = image.copy()
+    height, width = image.shape[:2]
+    cv2.rectangle(changed, (width // 3, height // 3), (width // 3 + 120, height // 3 + 40), (0, 0, 200), -1)
+    cv2.putText(changed, 'Changed', (width // 3 + 5, height // 3 + 28), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return changed
+
+
+def timed(function, repeat):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - tic)
+    return result, runs
+
+
+class Benchmark(object):
+
+    def __init__(self, repeat, directory, engines):
+        self.repeat = repeat
+        self.directory = directory
+        self.engines = engines
+        self.results = []
+        self.library = ImageCompare(async_artifacts=False, reference_cache_size=0)
+        self.library.robot_variables = {'${LOG FILE}': os.path.join(directory, 'log.html')}
+
+    def record(self, case, stage, function):
+        result, runs = timed(function, self.repeat)
+        self.results.append(dict(case, stage=stage, seconds=statistics.median(runs), runs=runs))
+        print('{size_mp:>6} MP {pages} page(s) mask={mask!s:<5} {variant:<9} {stage:<22} {seconds:0.4f} s'.format(**self.results[-1]), file=sys.__stdout__)
+        return result
+
+    def run_case(self, megapixels, pages, mask, variant):
+        case = {'size_mp': megapixels, 'pages': pages, 'mask': mask, 'variant': variant}
+        references, candidates = [], []
+        for page in range(pages):
+            reference = synthetic_image(megapixels, seed=page)
+            candidate = reference.copy() if variant == 'identical' else slightly_different(reference)
+            for name, image, paths in (('reference', reference, references), ('candidate', candidate, candidates)):
+                path = os.path.join(self.directory, '{}mp_{}_{}_{}.png'.format(megapixels, variant, name, page))
+                cv2.imwrite(path, image)
+                paths.append(path)
+        mask_argument = MASK if mask else None
+
+        for page, (reference_path, candidate_path) in enumerate(zip(references, candidates)):
+            page_case = dict(case, page=page + 1)
+            reference_image = self.record(page_case, 'load', lambda: CompareImage(reference_path, mask=mask_argument))
+            candidate_image = CompareImage(candidate_path)
+            reference, candidate = reference_image.opencv_images[0], candidate_image.opencv_images[0]
+            comparison_mask = None
+            if mask:
+                def compile_mask():
+                    compare_image_module._comparison_masks.clear()
+                    return reference_image.get_comparison_mask(0)
+                comparison_mask = self.record(page_case, 'mask_compile', compile_mask)
+            grayA, grayB = self.record(page_case, 'grayscale', lambda: (cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY), cv2.cvtColor(candidate, cv2.COLOR_BGR2GRAY)))
+            result = None
+            for engine in self.engines:
+                for strategy in ('full', 'pyramid'):
+                    stage = 'ssim_{}'.format(engine) + ('_pyramid' if strategy == 'pyramid' else '')
+                    result = self.record(page_case, stage, lambda: get_metric('ssim')(grayA, grayB, mask=comparison_mask, engine=engine, strategy=strategy))
+            self.record(page_case, 'pixel', lambda: get_metric('pixel')(reference, candidate, mask=comparison_mask))
+            diff, thresh = result.difference_maps()
+            self.record(page_case, 'contours', lambda: self.library.get_images_with_highlighted_differences(thresh, reference.copy(), candidate.copy(), extension=2))
+            self.record(page_case, 'screenshot', lambda: self.library.add_screenshot_to_log(np.concatenate((reference, candidate), axis=1), '_benchmark'))
+
+        def compare_images():
+            for reference_path, candidate_path in zip(references, candidates):
+                try:
+                    self.library.compare_images(reference_path, candidate_path, mask=mask_argument, engine=self.engines[-1])
+                except AssertionError:
+                    pass
+        self.record(case, 'compare_images', compare_images)
+
+
+def environment():
+    versions = {'python': platform.python_version(), 'opencv': cv2.__version__, 'numpy': np.__version__}
+    try:
+        import skimage
+        versions['scikit-image'] = skimage.__version__
+    except ImportError:
+        pass
+    return dict(versions, platform=platform.platform(), machine=platform.machine(), cpus=os.cpu_count())
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16], help='image sizes in megapixels')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 3], help='page counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the median is reported')
+    parser.add_argument('--engines', nargs='+', default=['skimage', 'opencv'], help='SSIM engines')
+    parser.add_argument('--output', default='benchmark.json', help='JSON result file')
+    options = parser.parse_args(arguments)
+
+    # the output of the library is discarded, progress is printed to sys.__stdout__
+    with tempfile.TemporaryDirectory() as directory, redirect_stdout(io.StringIO()):
+        benchmark = Benchmark(options.repeat, directory, options.engines)
+        for megapixels in options.sizes:
+            for pages in options.pages:
+                for mask in (False, True):
+                    for variant in ('identical', 'different'):
+                        benchmark.run_case(megapixels, pages, mask, variant)
+        benchmark.library.close()
+
+    with open(options.output, 'w') as f:
+        json.dump({'environment': environment(), 'repeat': options.repeat, 'results': benchmark.results}, f, indent=2)
+    print('Benchmark results written to {}'.format(options.output))
+
+
+if __name__ == '__main__':
+    main()
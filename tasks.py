@@ -28,6 +28,18 @@ def tests(context):
     subprocess.run("coverage report", shell=True, check=False)
     subprocess.run("coverage html", shell=True, check=False)
 
+@task
+def benchmark(context, sizes="1 4 16", pages="1 3", repeat=3, output="benchmark.json"):
+    cmd = [
+        "python",
+        f"{ROOT}/benchmark/benchmark.py",
+        f"--sizes {sizes}",
+        f"--pages {pages}",
+        f"--repeat {repeat}",
+        f"--output {output}",
+    ]
+    subprocess.run(" ".join(cmd), shell=True, check=False)
+
 @task
 def libdoc(context):
     print(f"Generating libdoc for library version {VERSION}")